@@ -5,11 +5,14 @@ from .hybrid_model import HybridLanguageModel
 from . import utils
 
 
-def model_loader(modelpath):
+def model_loader(modelpath, quantize=False, mmap=False):
     """
     General function to load models
 
     modelpath is a string /path/to/modelname (no extension)
+    quantize: whether to apply dynamic int8 quantization (cpu inference only)
+    mmap: whether to memory-map the weights (shared by processes loading the
+        same model, see `RNNLanguageModel.load`)
     """
     import os
 
@@ -17,19 +20,36 @@ def model_loader(modelpath):
     modelname = os.path.basename(modelpath)
 
     if modelname.startswith('RNNLanguageModel'):
-        model, encoder = RNNLanguageModel.load(modelpath, utils.CorpusEncoder)
+        model, encoder = RNNLanguageModel.load(modelpath, utils.CorpusEncoder, mmap=mmap)
     elif modelname.startswith('HybridLanguageModel'):
-        model, encoder = HybridLanguageModel.load(modelpath, utils.CorpusEncoder)
+        model, encoder = HybridLanguageModel.load(modelpath, utils.CorpusEncoder, mmap=mmap)
     elif modelname.startswith('CharLanguageModel'):
-        model, encoder = CharLanguageModel.load(modelpath, CharLevelCorpusEncoder)
+        model, encoder = CharLanguageModel.load(modelpath, CharLevelCorpusEncoder, mmap=mmap)
     else:
         raise ValueError("Couldn't identify {} as model".format(modelpath))
 
     # always load on eval mode
     model.eval()
+    # run the stacked layers as a single multi-layer rnn
+    model.pack_rnn()
+    if quantize:
+        model.quantize()
+
+    # word-level model: precompute char-level embeddings for faster sampling
+    if type(model) is RNNLanguageModel:
+        model.embed_vocab(encoder)
+    # hybrid model: build the char-to-word lookup used by the char-level decoder
+    elif type(model) is HybridLanguageModel:
+        model.char_trie = utils.CharTrie(encoder.word, encoder.char)
+
+    # compiled decoding step (scripted from the loaded, possibly shared, weights)
+    if model.has_step_module and (model.packed_rnn is not None or len(model.rnn) == 1):
+        model.compile_step()
 
     return model, encoder
 
 
-from .cache import Cache
+from .cache import Cache, ProjectionIndex
 from .generator import TemplateSampler, sample_conditions
+from .templates import TemplateStore
+from .registry import ModelRegistry
@@ -12,10 +12,17 @@ class Cache(object):
     """
     Continuous Cache for Neural Models following: https://arxiv.org/abs/1612.04426
 
+    The cache is a ring buffer that is updated in place by `add` (use `fork` to
+    get an independent copy).
+
     Parameters:
     -----------
     memkeys
     memvals
+    topk: int or None, only use the `topk` best scoring entries per query
+    index: object or None, approximate search index used to retrieve the `topk`
+        entries (see `ProjectionIndex`). If None, the `topk` entries are found
+        exactly by partial sort of the full dot product.
 
     Attributes:
     -----------
@@ -24,7 +31,7 @@ class Cache(object):
     stored: int, number of steps stored
     current: int, current first empty spot
     """
-    def __init__(self, memkeys, memvals, stored=0, current=0):
+    def __init__(self, memkeys, memvals, stored=0, current=0, topk=None, index=None):
         self.memkeys = memkeys
         self.memvals = memvals
         self.device = self.memkeys.device
@@ -33,18 +40,36 @@ class Cache(object):
         self.dim = dim
         self.stored = stored    # number of items stored in the cache
         self.current = current  # index along size that should get written
+        self.penalties = {}     # precomputed closeness penalties
+        self.topk = topk
+        self.index = index
 
     @classmethod
-    def new(cls, dim, size, device='cpu'):
-        memkeys = torch.zeros(size, 1, dim).to(device)
-        memvals = torch.zeros(size, 1, dtype=torch.int64).to(device)
-        return cls(memkeys, memvals)
+    def new(cls, dim, size, device='cpu', batch=1, topk=None, index=None):
+        memkeys = torch.zeros(size, batch, dim).to(device)
+        memvals = torch.zeros(size, batch, dtype=torch.int64).to(device)
+        return cls(memkeys, memvals, topk=topk, index=index)
 
     def reset(self):
-        return Cache.new(self.dim, self.size, device=self.device)
+        """
+        Empty the cache (in place)
+        """
+        self.stored = self.current = 0
+        return self
+
+    def fork(self):
+        """
+        Return a copy of the cache that can be updated independently
+        """
+        index = self.index.fork() if self.index is not None else None
+        return Cache(self.memkeys.clone(), self.memvals.clone(),
+                     stored=self.stored, current=self.current,
+                     topk=self.topk, index=index)
 
     def add(self, keys, vals):
         """
+        Write keys and values at the current position (in place)
+
         Parameters:
         -----------
         keys: torch.Tensor(n, batch, dim)
@@ -55,41 +80,37 @@ class Cache(object):
                 str(keys.size()), str(vals.size())))
 
         batch = keys.size(1)
-        memkeys, memvals = self.memkeys, self.memvals
 
-        if memkeys.size(1) == 1 and batch > 1:
-            # expand along batch dimension
-            memkeys = memkeys.repeat(1, batch, 1)
-            memvals = memvals.repeat(1, batch)
+        if self.memkeys.size(1) == 1 and batch > 1:
+            # expand along batch dimension (only happens once)
+            self.memkeys = self.memkeys.repeat(1, batch, 1)
+            self.memvals = self.memvals.repeat(1, batch)
 
-        if memkeys.size(1) != batch:
+        if self.memkeys.size(1) != batch:
             raise ValueError(
                 "Wrong batch dimension. Expected {} but got {} elements".format(
-                    memkeys.size(1), batch))
+                    self.memkeys.size(1), batch))
 
         if keys.size(0) > self.size:
             keys, vals = keys[-self.size:], vals[-self.size:]
 
-        limit = min(self.size, self.current + keys.size(0))
-        index = torch.arange(self.current, limit, dtype=torch.int64, device=self.device)
-        memkeys = memkeys.index_copy(0, index, keys[:len(index)])
-        memvals = memvals.index_copy(0, index, vals[:len(index)])
-
-        # update current
-        current = limit % self.size
-
-        if len(index) < len(keys):
-            indexed = len(index)
-            index = torch.arange(current, len(keys) - indexed,
-                                 dtype=torch.int64, device=self.device)
-            memkeys = memkeys.index_copy(0, index, keys[indexed:])
-            memvals = memvals.index_copy(0, index, vals[indexed:])
-            current = len(keys) - indexed
+        # write until the end of the buffer and wrap around for the rest
+        n = len(keys)
+        head = min(n, self.size - self.current)
+        self.memkeys[self.current:self.current+head].copy_(keys[:head])
+        self.memvals[self.current:self.current+head].copy_(vals[:head])
+        if self.index is not None:
+            self.index.write(self, self.current, keys[:head])
+        if head < n:
+            self.memkeys[:n-head].copy_(keys[head:])
+            self.memvals[:n-head].copy_(vals[head:])
+            if self.index is not None:
+                self.index.write(self, 0, keys[head:])
 
-        # update stored
-        stored = min(self.size, self.stored + len(keys))
+        self.current = (self.current + n) % self.size
+        self.stored = min(self.size, self.stored + n)
 
-        return Cache(memkeys, memvals, current=current, stored=stored)
+        return self
 
     def query(self, query):
         """
@@ -103,16 +124,76 @@ class Cache(object):
             with the keys in the cache
         vals: torch.LongTensor(batch, size)
         """
+        scores, positions = self.search(query)
+
+        return scores, self.get_vals(positions)
+
+    def search(self, query):
+        """
+        Score the entries in the cache given an input query. If the cache was
+        created with `topk`, only the best `topk` entries are returned.
+
+        Returns:
+        --------
+        scores: torch.Tensor(batch, size) or torch.Tensor(batch, topk)
+        positions: None if all entries are returned or torch.LongTensor(batch, topk)
+            with the position of the returned entries in the cache
+        """
+        if self.topk is not None and self.topk < self.stored:
+            if self.index is not None:
+                return self.index.search(self, query, self.topk)
+            scores, _ = self.search_exact(query)
+            return scores.topk(self.topk, dim=1)
+
+        return self.search_exact(query)
+
+    def search_exact(self, query):
         # select full entries
-        memkeys, memvals = self.memkeys[:self.stored], self.memvals[:self.stored]
+        memkeys = self.memkeys[:self.stored]
         # dot product => (batch x size)
         scores = (memkeys * query.unsqueeze(0)).sum(2)
 
-        return scores.t(), memvals.t()
+        return scores.t(), None
+
+    def get_vals(self, positions=None):
+        """
+        Return the values at given (batch x n) positions (all entries if None)
+        """
+        memvals = self.memvals[:self.stored].t()
+        if positions is None:
+            return memvals
+
+        return memvals.gather(1, positions)
+
+    def get_penalty(self, size, penalty, npenalty):
+        """
+        Closeness penalty over the `size` entries in the cache: the `npenalty`
+        most recent entries get downweighted by a factor linearly interpolated
+        from `penalty` (most recent) to 1. The decay vector is precomputed once
+        per (size, penalty, npenalty) and rolled to the current ring position.
+
+        Returns:
+        --------
+        torch.Tensor(size)
+        """
+        # never penalize entries more than just once
+        npenalty = min(npenalty, size)
+        key = size, penalty, npenalty
+
+        if key not in self.penalties:
+            # linear interpolation towards `penalty` (most recent entry)
+            decay = torch.ones(size).to(self.device)
+            decay[size-npenalty:] = torch.linspace(
+                penalty + (1 - penalty) / npenalty * (npenalty - 1), penalty, npenalty)
+            self.penalties[key] = decay
+
+        # most recent entry is at `current - 1`
+        return torch.roll(self.penalties[key], self.current)
 
     def interpolate(self, query, logits, alpha, theta, penalty=None, npenalty=None):
         # query
-        cache_logits, vals = self.query(query)
+        cache_logits, positions = self.search(query)
+        vals = self.get_vals(positions)
 
         # apply closeness penalty
         if penalty is not None:
@@ -121,29 +202,87 @@ class Cache(object):
             if npenalty is None:
                 raise ValueError("`penalty` requires `npenalty`")
 
-            _, size = cache_logits.size()
-            # never penalize entries more than just once
-            npenalty = min(npenalty, size)
-            # linear interpolation from `penalty` to 1
-            m = (1 - penalty) / npenalty
-            for i in range(npenalty):
-                # idx: negative index to previous to current
-                idx = size - self.current + 1 + i
-                cache_logits[:, -(idx % size)] *= penalty + (m * i)
+            decay = self.get_penalty(self.stored, penalty, npenalty)
+            cache_logits *= decay if positions is None else decay[positions]
 
         # interpolate
         cache_prob = alpha * F.softmax(theta * cache_logits, dim=1)
-        prob = (1 - alpha) * F.softmax(logits, dim=1)
-        prob = torch_utils.batch_index_add(prob, vals, cache_prob)
+        prob = F.softmax(logits, dim=1).mul_(1 - alpha)
+        prob = torch_utils.batch_index_add(prob, vals, cache_prob, out=prob)
 
         return prob
 
 
-def evaluate(model, encoder, dev, cache_size=200, alpha=0.1, theta=0.1, batch=1):
+class ProjectionIndex(object):
+    """
+    Approximate inner product search over the keys of a `Cache` based on random
+    projections (SimHash). Entries are shortlisted by the agreement between the
+    sign bits of their projection and the projection of the query, and the
+    shortlist (`shortlist` times the requested number of entries) is rescored
+    exactly.
+
+    Parameters:
+    -----------
+    nbits: int, number of random projections
+    shortlist: int, shortlist size as a multiple of the requested entries
+    """
+    def __init__(self, nbits=32, shortlist=4):
+        self.nbits = nbits
+        self.shortlist = shortlist
+        self.proj = None    # (dim x nbits)
+        self.codes = None   # (size x batch x nbits)
+
+    def fork(self):
+        inst = ProjectionIndex(nbits=self.nbits, shortlist=self.shortlist)
+        inst.proj = self.proj
+        inst.codes = self.codes.clone() if self.codes is not None else None
+        return inst
+
+    def encode(self, keys):
+        return torch.matmul(keys, self.proj).gt(0).float() * 2 - 1
+
+    def write(self, cache, start, keys):
+        """
+        Write the codes for keys (n x batch x dim) stored at `start`
+        """
+        batch = keys.size(1)
+        if self.codes is None:
+            self.proj = torch.randn(cache.dim, self.nbits).to(cache.device)
+            self.codes = torch.zeros(cache.size, batch, self.nbits).to(cache.device)
+        if self.codes.size(1) == 1 and batch > 1:
+            # expand along batch dimension (following the cache)
+            self.codes = self.codes.repeat(1, batch, 1)
+
+        self.codes[start:start+len(keys)].copy_(self.encode(keys))
+
+    def search(self, cache, query, k):
+        """
+        Returns:
+        --------
+        scores: torch.Tensor(batch, k)
+        positions: torch.LongTensor(batch, k)
+        """
+        batch = query.size(0)
+        # (stored x batch)
+        agreement = (self.codes[:cache.stored] * self.encode(query).unsqueeze(0)).sum(2)
+        # (batch x m) shortlisted positions
+        _, shortlist = agreement.t().topk(min(cache.stored, k * self.shortlist), dim=1)
+        # (batch x m x dim)
+        keys = cache.memkeys.transpose(0, 1)[
+            torch.arange(batch).to(cache.device).unsqueeze(1), shortlist]
+        scores = (keys * query.unsqueeze(1)).sum(2)
+        scores, best = scores.topk(k, dim=1)
+
+        return scores, shortlist.gather(1, best)
+
+
+def evaluate(model, encoder, dev, cache_size=200, alpha=0.1, theta=0.1, batch=1,
+             topk=None, index=None):
     """
     Evaluate model using a cache
     """
-    cache = Cache.new(model.hidden_dim, cache_size, model.device)
+    cache = Cache.new(model.hidden_dim, cache_size, model.device, batch=batch,
+                      topk=topk, index=index)
     hidden = None
     tloss, tinsts = 0, 0
 
@@ -186,6 +325,128 @@ def evaluate(model, encoder, dev, cache_size=200, alpha=0.1, theta=0.1, batch=1)
     return model.loss_formatter(tloss / tinsts)
 
 
+def collect(model, encoder, dev, cache_size=200, batch=1, path=None):
+    """
+    Run the model once over the dev set and store the per-token statistics that
+    are needed to compute the cache loss for any (alpha, theta) with `sweep`:
+
+        - prob : (N), model probability of the target
+        - scores : (N x cache_size), dot product of the query with the cache keys
+        - match : (N x cache_size), whether the cache entry is the target
+        - stored : (N), number of filled entries in the cache
+        - weight : (N), loss weight of the target
+
+    If `path` is given, statistics are written to disk and memory-mapped instead
+    of being kept in memory.
+    """
+    cache = Cache.new(model.hidden_dim, cache_size, model.device, batch=batch)
+    hidden = None
+    tinsts = 0
+    stats = {'prob': [], 'scores': [], 'match': [], 'stored': [], 'weight': []}
+    dtypes = {'prob': 'float32', 'scores': 'float32', 'match': 'uint8',
+              'stored': 'int64', 'weight': 'float32'}
+    files = {key: open('{}.{}'.format(path, key), 'wb') for key in stats} if path else {}
+
+    def store(key, t):
+        t = t.to(getattr(torch, dtypes[key])).cpu()
+        if path:
+            t.numpy().tofile(files[key])
+        else:
+            stats[key].append(t)
+
+    with torch.no_grad():
+
+        for stuff in tqdm.tqdm(dev.get_batches(batch, yield_stops=True)):
+
+            if stuff is None:  # avoid cache reaching over different sentences
+                cache = cache.reset()
+                continue
+
+            sents, conds = stuff
+
+            (words, nwords), (chars, nchars), conds = encoder.transform_batch(
+                sents, conds, model.device)
+
+            # outs: (seq x batch x hidden_dim)
+            outs, hidden = model(
+                words, nwords, chars, nchars, conds, hidden=hidden, project=False)
+
+            sources, targets = outs[:-1], words[1:]
+
+            for source, target in zip(sources, targets):
+                # (batch x vocab)
+                prob = F.softmax(model.proj(source), dim=1)
+                store('prob', prob.gather(1, target.unsqueeze(1)).squeeze(1))
+                store('weight', model.nll_weight[target])
+                store('stored', torch.full_like(target, cache.stored))
+
+                # (batch x cache_size), empty entries are masked later on
+                scores = torch.zeros(len(target), cache_size).to(model.device)
+                match = torch.zeros(len(target), cache_size).to(model.device)
+                if cache.stored > 0:
+                    cache_logits, vals = cache.query(source)
+                    scores[:, :cache.stored] = cache_logits
+                    match[:, :cache.stored] = vals.eq(target.unsqueeze(1)).float()
+                store('scores', scores)
+                store('match', match)
+
+                cache = cache.add(source.unsqueeze(0), target.unsqueeze(0))
+
+            tinsts += (sum(nwords) - batch)  # remove 1 per instance
+
+    if path:
+        import numpy as np
+        for f in files.values():
+            f.close()
+        for key, dtype in dtypes.items():
+            data = np.memmap('{}.{}'.format(path, key), mode='r', dtype=dtype)
+            if key in ('scores', 'match'):
+                data = data.reshape(-1, cache_size)
+            stats[key] = data
+    else:
+        stats = {key: torch.cat(vals) for key, vals in stats.items()}
+
+    stats['insts'] = tinsts
+
+    return stats
+
+
+def sweep(stats, alphas, thetas, chunk=5000):
+    """
+    Compute the cache loss for every combination of `alphas` and `thetas` from
+    the output of `collect`, vectorized over the grid.
+
+    Returns:
+    --------
+    torch.Tensor(len(alphas) x len(thetas)), average loss per token
+    """
+    # (T x 1 x 1)
+    thetas = torch.tensor(thetas, dtype=torch.float32).view(-1, 1, 1)
+    # (A x 1 x 1)
+    alphas = torch.tensor(alphas, dtype=torch.float32).view(-1, 1, 1)
+    loss = torch.zeros(alphas.size(0), thetas.size(0))
+
+    for start in range(0, len(stats['prob']), chunk):
+        prob, weight, stored, scores, match = [
+            torch.as_tensor(stats[key][start:start+chunk])
+            for key in ('prob', 'weight', 'stored', 'scores', 'match')]
+        n, size = scores.size()
+
+        # (n x size) filled entries (tokens with empty cache keep the first one
+        # to avoid nans, it is ignored by the interpolation anyway)
+        valid = torch.arange(size).unsqueeze(0) < stored.clamp(min=1).unsqueeze(1)
+        # (T x n x size) -> (T x n)
+        cache_logits = (thetas * scores).masked_fill(~valid, -float('inf'))
+        cache_prob = (F.softmax(cache_logits, dim=-1) * match.float()).sum(-1)
+        # (A x 1 x n): no interpolation if the cache was empty
+        mix = alphas * (stored > 0).float()
+        # (A x T x n)
+        interpolated = prob + mix * (cache_prob - prob)
+        loss -= (interpolated.add(1e-8).log() * weight).sum(-1)
+
+    return loss / stats['insts']
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -194,6 +455,12 @@ if __name__ == '__main__':
     parser.add_argument('--dpath', default='./data/ohhla.vocab.phon.json')
     parser.add_argument('--size', default=200, type=int)
     parser.add_argument('--device', default='cpu')
+    parser.add_argument('--sweep', action='store_true',
+                        help='run the model once and score the grid from stored stats')
+    parser.add_argument('--store', help='/path/prefix to memory-map the sweep stats')
+    parser.add_argument('--topk', type=int, help='only use the topk cache entries')
+    parser.add_argument('--approximate', action='store_true',
+                        help='retrieve topk entries with an approximate index')
     args = parser.parse_args()
 
     from generation import utils, model_loader
@@ -212,11 +479,25 @@ if __name__ == '__main__':
     model.eval()
 
     dev = utils.CorpusReader(args.dev, dpath=args.dpath or None)
-    grid = itertools.product(range_float(0, 1, 0.1), range_float(0, 0.5, 0.05))
 
     with open("{}.cache.eval.csv".format(model.modelname), 'w') as f:
         f.write("alpha,theta,loss\n")
-        for theta, alpha in grid:
-            loss = evaluate(
-                model, encoder, dev, cache_size=args.size, alpha=alpha, theta=theta)
-            f.write("{},{},{}\n".format(alpha, theta, loss))
+
+        if args.sweep:
+            # run the model only once and score the full grid from the stats
+            stats = collect(model, encoder, dev, cache_size=args.size, path=args.store)
+            thetas, alphas = list(range_float(0, 1, 0.1)), list(range_float(0, 0.5, 0.05))
+            losses = sweep(stats, alphas, thetas)
+            for (a, alpha), (t, theta) in itertools.product(
+                    enumerate(alphas), enumerate(thetas)):
+                loss = model.loss_formatter(losses[a, t].item())
+                f.write("{},{},{}\n".format(alpha, theta, loss))
+
+        else:
+            grid = itertools.product(range_float(0, 1, 0.1), range_float(0, 0.5, 0.05))
+            for theta, alpha in grid:
+                loss = evaluate(
+                    model, encoder, dev, cache_size=args.size, alpha=alpha, theta=theta,
+                    topk=args.topk,
+                    index=ProjectionIndex() if args.approximate else None)
+                f.write("{},{},{}\n".format(alpha, theta, loss))
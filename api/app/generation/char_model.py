@@ -1,5 +1,4 @@
 
-import collections
 import math
 import random
 import time
@@ -52,6 +51,10 @@ class CharLanguageModel(RNNLanguageModel):
         self.dropout = dropout
         self.modelname = self.get_modelname()
         super(RNNLanguageModel, self).__init__()
+        # multi-layer copy of `self.rnn` used at inference, see `pack_rnn`
+        self.packed_rnn = None
+        # compiled `DecodeStep` used by `step`, see `compile_step`
+        self.step_fn = None
 
         cvocab = encoder.char.size()
 
@@ -92,6 +95,9 @@ class CharLanguageModel(RNNLanguageModel):
         kwargs = {'dropout': self.dropout}
         return args, kwargs
 
+    def get_input_embs(self):
+        return self.embs
+
     def forward(self, word, nwords, char, nchars, conds, hidden=None):
         # dropout!: embedding dropout (dropoute), not implemented
         # - embeddings
@@ -116,15 +122,20 @@ class CharLanguageModel(RNNLanguageModel):
         outs = embs
         hidden_ = []
         hidden = hidden or [None] * len(self.rnn)
-        for l, rnn in enumerate(self.rnn):
-            outs, h_ = rnn(outs, hidden[l])
-            if l != len(self.rnn) - 1:
-                outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
-                # dropout!: hidden dropout (dropouth)
-                outs = torch_utils.sequential_dropout(
-                    outs, self.dropout, self.training)
-                outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
-            hidden_.append(h_)
+        if self.packed_rnn is not None:
+            # inference: run all layers with a single call (see `pack_rnn`)
+            outs, hidden_ = self.run_rnn(outs, self.pack_hidden(hidden))
+            hidden_ = self.unpack_hidden(hidden_)
+        else:
+            for l, rnn in enumerate(self.rnn):
+                outs, h_ = rnn(outs, hidden[l])
+                if l != len(self.rnn) - 1:
+                    outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
+                    # dropout!: hidden dropout (dropouth)
+                    outs = torch_utils.sequential_dropout(
+                        outs, self.dropout, self.training)
+                    outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
+                hidden_.append(h_)
         outs, _ = nn.utils.rnn.pad_packed_sequence(outs)
         outs = outs[:, unsort]
         hidden = hidden_
@@ -162,9 +173,11 @@ class CharLanguageModel(RNNLanguageModel):
         return math.log2(math.e) * loss
 
     def sample(self, encoder, nsyms=100, batch=1,
-               conds=None, hidden=None, tau=1.0, cache=None, **kwargs):
+               conds=None, hidden=None, tau=1.0, cache=None, top_k=0, top_p=1.0,
+               **kwargs):
         """
-        Generate stuff
+        Generate stuff (`conds` and `tau` can be given per row as lists of `batch`
+        values, see `RNNLanguageModel.sample`)
         """
         # batch
         if hidden is not None:
@@ -174,6 +187,8 @@ class CharLanguageModel(RNNLanguageModel):
                 batch = hidden[0].size(1)
         else:
             hidden = [None] * len(self.rnn)
+        # stacked layers (if packed) are run with a single call, see `run_rnn`
+        hidden = self.pack_hidden(hidden)
 
         # sample conditions if needed
         conds, bconds = conds or {}, []
@@ -182,44 +197,44 @@ class CharLanguageModel(RNNLanguageModel):
             if c not in conds:
                 conds[c] = random.choice(list(encoder.conds[c].w2i.values()))
             # compute embedding
-            bcond = torch.tensor([conds[c]] * batch, dtype=torch.int64).to(self.device)
+            bcond = torch_utils.batch_values(conds[c], batch).to(self.device)
             bcond = self.conds[c](bcond)
             bconds.append(bcond.expand(1, batch, -1))
+        # (1 x batch x cond_dim * nconds)
+        bconds = torch.cat(bconds, -1) if bconds else torch.zeros(1, batch, 0).to(self.device)
+
+        # per-row temperature
+        if isinstance(tau, (list, tuple)):
+            tau = torch_utils.batch_values(tau, batch, dtype=torch.float).to(self.device)
 
         char = [encoder.char.bos] * batch  # (batch)
         char = torch.tensor(char, dtype=torch.int64).to(self.device)
+        # no char-level embedding of the input
+        cemb = torch.zeros(1, batch, 0).to(self.device)
 
-        output = collections.defaultdict(list)
+        # (nsyms x batch) sampled char ids and number of valid ids per row
+        output = torch.zeros(nsyms, batch, dtype=torch.int64).to(self.device)
+        lengths = torch.zeros(batch, dtype=torch.int64).to(self.device)
         mask = torch.ones(batch, dtype=torch.int64).to(self.device)
-        scores = 0
+        scores = torch.zeros(batch).to(self.device)
+        # batch indices of the rows in the working batch (finished rows are dropped)
+        active = torch.arange(batch, dtype=torch.int64).to(self.device)
+        output_hidden = None
 
         with torch.no_grad():
-            for _ in range(nsyms):
+            for step in range(nsyms):
                 # check if done
-
-                if sum(mask).item() == 0:
+                if len(active) == 0:
                     break
 
-                # embeddings
-                embs = self.embs(char.unsqueeze(0))
-                if conds:
-                    embs = torch.cat([embs, *bconds], -1)
-
-                # rnn
-                outs = embs
-                hidden_ = []
-                hidden = hidden or [None] * len(self.rnn)
-                for l, rnn in enumerate(self.rnn):
-                    outs, h_ = rnn(outs, hidden[l])
-                    hidden_.append(h_)
+                # (batch x vocab)
+                preds, hidden_, _ = self.step(char, cemb, bconds, hidden)
                 # only update hidden for active instances
                 hidden = torch_utils.update_hidden(hidden, hidden_, mask)
 
-                # get probs
-                # (1 x batch x vocab) -> (batch x vocab)
-                logits = self.proj(outs).squeeze(0)
-                preds = F.log_softmax(logits, dim=-1)
-                char = (preds / tau).exp().multinomial(1)
+                # sample
+                slogits = torch_utils.process_logits(preds, tau=tau, top_k=top_k, top_p=top_p)
+                char = F.softmax(slogits, dim=-1).multinomial(1)
                 score = preds.gather(1, char)
                 char, score = char.squeeze(1), score.squeeze(1)
 
@@ -227,16 +242,37 @@ class CharLanguageModel(RNNLanguageModel):
                 mask = mask * char.ne(encoder.char.eos).long()
 
                 # accumulate
-                scores += score * mask.float()
-                for idx, (active, c) in enumerate(zip(mask.tolist(), char.tolist())):
-                    if active:
-                        output[idx].append(encoder.char.i2w[c])
+                scores.index_add_(0, active, score * mask.float())
+                output[step].index_copy_(0, active, char)
+                lengths.index_add_(0, active, mask)
+
+                # drop finished rows from the working batch
+                if mask.sum().item() < len(mask):
+                    keep, done = mask.nonzero().view(-1), (1 - mask).nonzero().view(-1)
+                    output_hidden = torch_utils.scatter_hidden(
+                        output_hidden, torch_utils.select_hidden(hidden, done),
+                        active[done], batch)
+                    hidden = torch_utils.select_hidden(hidden, keep)
+                    active, mask, char = active[keep], mask[keep], char[keep]
+                    bconds, cemb = bconds[:, keep], cemb[:, keep]
+                    if torch.is_tensor(tau):
+                        tau = tau[keep]
+
+            # write back hidden state of unfinished rows
+            if len(active) > 0 and hidden[0] is not None:
+                output_hidden = torch_utils.scatter_hidden(
+                    output_hidden, hidden, active, batch)
+
+        if output_hidden is not None:
+            hidden = output_hidden
+        hidden = self.unpack_hidden(hidden)
 
         # transform output to list-batch of hyps
-        output = [output[i] for i in range(len(output))]
+        output = [[encoder.char.i2w[c] for c in hyp[:length]]
+                  for hyp, length in zip(output.t().tolist(), lengths.tolist())]
 
         # prepare output
-        conds = {c: encoder.conds[c].i2w[cond] for c, cond in conds.items()}
+        conds = encoder.decode_conds(conds)
         hyps, probs = [], []
         for hyp, score in zip(output, scores):
             try:
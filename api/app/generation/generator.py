@@ -2,64 +2,118 @@
 import time
 import sys
 import os
+import collections
 import json
 import random
 import uuid
 import warnings
 
-from . import utils, model_loader, Cache
+import torch
 
+from . import utils, torch_utils, model_loader, Cache
+from .templates import TemplateStore
+from .registry import ModelRegistry
 
-def load_models(dirpath):
-    models = {}
 
-    for modelname in os.listdir(dirpath):
-        if not modelname.endswith('.pt'):
-            continue
+def load_model(modelpath):
+    print("Loading model: {}".format(modelpath))
+    model, encoder = model_loader(modelpath, mmap=True)
+    return {'model': model, 'encoder': encoder}
 
-        modelname = '.'.join(modelname.split('.')[:-1])
 
-        if modelname in models:
-            continue
+def load_models(dirpath):
+    """
+    Registry of the models in `dirpath`, loaded on first use
+    """
+    return ModelRegistry(dirpath, load=load_model)
 
-        print("Loading model: {}".format(os.path.join(dirpath, modelname)))
-        model, encoder = model_loader(os.path.join(dirpath, modelname))
-        models[modelname] = {'model': model, 'encoder': encoder}
 
-    return models
+class SongIndex:
+    """
+    Byte offsets and verse lengths of all verses in a songs file (jsonl), so
+    that verses can be sampled by seeking to a single line. The index is built
+    once and persisted next to the file (rebuilt if the file changes).
+    """
+    def __init__(self, offsets, verses, lengths):
+        self.offsets = offsets    # (nverses) byte offset of the song line
+        self.verses = verses      # (nverses) verse index in the song
+        self.lengths = lengths    # (nverses) number of lines in the verse
+        self.candidates = {}      # nlines -> indices of verses with enough lines
+
+    @staticmethod
+    def get_path(fpath):
+        return fpath + '.index'
+
+    @staticmethod
+    def get_stamp(fpath):
+        stat = os.stat(fpath)
+        return stat.st_size, stat.st_mtime
+
+    @classmethod
+    def build(cls, fpath):
+        offsets, verses, lengths = [], [], []
+        with open(fpath, 'rb') as f:
+            offset = 0
+            for line in f:
+                try:
+                    for verse, lines in enumerate(json.loads(line)['text']):
+                        offsets.append(offset)
+                        verses.append(verse)
+                        lengths.append(len(lines))
+                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                    pass  # corrupted line
+                offset += len(line)
+
+        return cls(torch.tensor(offsets, dtype=torch.int64),
+                   torch.tensor(verses, dtype=torch.int64),
+                   torch.tensor(lengths, dtype=torch.int64))
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Load the index of `fpath`, building (and storing) it if needed
+        """
+        path, stamp = cls.get_path(fpath), cls.get_stamp(fpath)
+        if os.path.isfile(path):
+            data = torch.load(path)
+            if tuple(data['stamp']) == stamp:
+                return cls(data['offsets'], data['verses'], data['lengths'])
 
+        print("Indexing songs file: {}".format(fpath))
+        index = cls.build(fpath)
+        torch.save({'stamp': stamp, 'offsets': index.offsets,
+                    'verses': index.verses, 'lengths': index.lengths}, path)
 
-def sample_file(fpath, rate=0.01):
-    f = open(fpath)
+        return index
 
-    while True:
-        try:
-            r = random.random()
-            if r < rate:
-                yield json.loads(next(f).strip())
-            else:
-                next(f)
-        except StopIteration:
-            f.close()
-            f = open(fpath)
-        except UnicodeDecodeError:
-            # corrupted file
-            continue
-        except json.decoder.JSONDecodeError:
-            # corrupted file
-            continue
+    def sample(self, nlines=None):
+        """
+        Sample a (song offset, verse) uniformly from all verses with at least
+        `nlines` lines
+        """
+        nlines = nlines or 0
+        if nlines not in self.candidates:
+            self.candidates[nlines] = (self.lengths >= nlines).nonzero().view(-1)
+        candidates = self.candidates[nlines]
+        if len(candidates) == 0:
+            raise RuntimeError("Couldn't find template of #{} lines".format(nlines))
+
+        idx = candidates[random.randrange(len(candidates))].item()
+
+        return self.offsets[idx].item(), self.verses[idx].item()
 
 
 class TemplateSampler:
     """
-    Sample from a file line by line based on a certain rate (n out of all lines)
+    Sample verse templates from a songs file (see `SongIndex`)
     """
     def __init__(self, fpath, dpath):
-        self.sampler = sample_file(fpath)
+        self.fpath = fpath
+        self.index = SongIndex.load(fpath)
         with open(dpath) as f:
             self.d = json.loads(f.read())
 
-    def sample(self, nlines=None, verbose=False):
+    def sample(self, nlines=None):
         """
         Arguments:
         ----------
@@ -71,47 +125,29 @@ class TemplateSampler:
         - template : list of dicts specifying conditions
         - metadata : dict of metadata associated with the verse (artist, id, album, etc.)
         """
-        tries, sample = 1, None
-
-        while sample is None:
-            try:
-                sample = self.sample_template(next(self.sampler), nlines)
-            except RuntimeError:
-                tries += 1
-                continue
-
-        if verbose:
-            print("Got sample after #{} tries".format(tries))
+        offset, verse = self.index.sample(nlines)
+        with open(self.fpath, 'rb') as f:
+            f.seek(offset)
+            song = json.loads(f.readline())
 
-        return sample
+        return self.get_template(song, verse)
 
-    def sample_template(self, song, nlines):
+    def get_template(self, song, verse):
         """
-        Auxiliary method
+        Compute the conditions of each line in the verse
         """
-        verses = list(range(len(song['text'])))
-        random.shuffle(verses)
-
         metadata = {"id": song['id'],
                     "album": song["album"],
                     "artist": song['artist'],
-                    "song": song["song"]}
-
-        while len(verses) > 0:
-            verse = verses.pop()
-
-            if nlines is None or len(song['text'][verse]) >= nlines:
-                metadata["verse"] = verse
-
-                template = []
-                for line in song['text'][verse]:
-                    _, conds = utils.prepare_line(line, d=self.d)
-                    template.append(conds)
-
-                return template, metadata
+                    "song": song["song"],
+                    "verse": verse}
 
-        raise RuntimeError("Couldn't find template of #{} lines".format(nlines))
+        template = []
+        for line in song['text'][verse]:
+            _, conds = utils.prepare_line(line, d=self.d)
+            template.append(conds)
 
+        return template, metadata
 
 def get_weights(encoder):
     weights = {}
@@ -145,7 +181,7 @@ class Generator:
     Arguments:
     ----------
     - modelpath : str, path to dir with models
-    - template_sampler : TemplateSampler
+    - template_sampler : TemplateSampler or TemplateStore
     - nlines : tuple of ints, range of lines to sample
     """
     def __init__(self, modelpath, template_sampler=None, nlines=(2, 3, 4), device='cpu'):
@@ -155,8 +191,9 @@ class Generator:
         self.device = device
 
     def sample(self, tries=1, sample_template=True, avoid_unk=True,
-               tau_mean=0.8, tau_std=0.075,
-               cache_size=0, alpha=0.15, theta=0.75):
+               tau_mean=0.8, tau_std=0.075, top_k=0, top_p=1.0,
+               cache_size=0, alpha=0.15, theta=0.75, constrain_rhyme=False,
+               mask_syllables=False):
         """
         Generate a stanza sampling:
 
@@ -173,8 +210,15 @@ class Generator:
         - tries : int, number of candidates per line
         - sample_template : bool, whether to use the , ignored if `Generator` wasn't
             instantiated with a `TemplateSampler`
-        - avoid_unk : bool, whether to downweight the logits for `<unk>` so as to
-            avoid sampling it during generation
+        - avoid_unk : bool, whether to suppress `<unk>` during generation
+        - top_k : int, sample only from the k most likely tokens (0 to disable)
+        - top_p : float, sample only from the nucleus of tokens with cumulative
+            probability `top_p` (1.0 to disable)
+        - constrain_rhyme : bool, only end lines with words of the rhyme condition
+            (see `utils.get_rhyme_masks`), ignored if `Generator` wasn't
+            instantiated with a `TemplateSampler` (needs the phonological dict)
+        - mask_syllables : bool, prevent broken syllable continuations during
+            generation instead of filtering them afterwards (word-level models)
 
         Returns: None if failed or a dict with the sample metadata
         --------
@@ -187,112 +231,246 @@ class Generator:
             warnings.warn("Using cache with a batch size bigger than 1 "
                           "might lead to unexpected results")
 
-        mconfig = random.choice(list(self.models.values()))
+        samples = self.sample_many(
+            1, tries=tries, sample_template=sample_template, avoid_unk=avoid_unk,
+            tau_mean=tau_mean, tau_std=tau_std, top_k=top_k, top_p=top_p,
+            cache_size=cache_size, alpha=alpha, theta=theta,
+            constrain_rhyme=constrain_rhyme, mask_syllables=mask_syllables)
+
+        if samples[0] is not None:
+            return samples[0]
+
+    def sample_many(self, n, tries=1, sample_template=True, avoid_unk=True,
+                    tau_mean=0.8, tau_std=0.075, top_k=0, top_p=1.0,
+                    cache_size=0, alpha=0.15, theta=0.75, constrain_rhyme=False,
+                    mask_syllables=False):
+        """
+        Generate `n` independent stanzas with the same (sampled) model, decoding
+        all of them in a single batch of `n * tries` rows. Nlines, tau and conds
+        are sampled per stanza and candidates are selected per stanza as in
+        `sample` (see there for the arguments). A cache (`cache_size`) is shared
+        along the batch and can therefore only be used with `n == 1`.
+
+        Returns: list of `n` samples (None for the stanzas that failed)
+        """
+        if cache_size and n > 1:
+            raise ValueError("Cache can't be used when sampling several stanzas")
+
+        mconfig = self.models[random.choice(list(self.models))]
         model, encoder = mconfig['model'], mconfig['encoder']
         model.to(self.device)
+        # word-level models validate lines over token ids
+        validate = model.modelname.startswith('RNN')
+
+        stanzas = []
+        for _ in range(n):
+            # best guess for nlines
+            nlines = random.choice(self.nlines)
+            # best guess for temperature
+            tau = random.gauss(tau_mean, tau_std)
+
+            template, tmeta, conds = None, None, None
+            if sample_template and self.template_sampler is not None:
+                template, tmeta = self.template_sampler.sample(nlines)
+                template = [{c: line[c] for c in encoder.conds} for line in template]
+            else:
+                conds = sample_conditions(encoder)
 
-        # best guess for nlines
-        nlines = random.choice(self.nlines)
-        # best guess for temperature
-        tau = random.gauss(tau_mean, tau_std)
-
-        template, tmeta, conds = None, None, None
-        if sample_template and self.template_sampler is not None:
-            template, tmeta = self.template_sampler.sample(nlines)
-            template = [{c: line[c] for c in encoder.conds} for line in template]
-        else:
-            conds = sample_conditions(encoder)
+            stanzas.append({'nlines': nlines, 'tau': tau, 'template': template,
+                            'tmeta': tmeta, 'conds': conds, 'prev': None, 'text': []})
 
         cache = None
         if cache_size:
-            cache = Cache.new(model.hidden_dim, cache_size, device=self.device)
-
-        text = []
-        hidden, prev = None, None
-        for line in range(nlines):
-
-            if template is not None:
-                conds = template[line]
+            cache = Cache.new(model.hidden_dim, cache_size, device=self.device, batch=tries)
+
+        rhyme_masks = None
+        d = getattr(self.template_sampler, 'd', None)
+        if constrain_rhyme and d is not None and 'rhyme' in encoder.conds:
+            if 'rhyme_masks' not in mconfig:
+                # register word-final syllables from the template songs
+                lines = ()
+                if getattr(self.template_sampler, 'fpath', None):
+                    lines = (line for line, _ in
+                             utils.lines_from_jsonl(self.template_sampler.fpath))
+                mconfig['rhyme_masks'] = utils.get_rhyme_masks(encoder, d, lines=lines)
+            rhyme_masks = mconfig['rhyme_masks']
+
+        # stanzas still being decoded (each takes `tries` consecutive rows)
+        running = list(range(n))
+        hidden = None
+        for line in range(max(stanza['nlines'] for stanza in stanzas)):
+            if not running:
+                break
+
+            # per-row conditions and temperature
+            conds, tau = collections.defaultdict(list), []
+            for i in running:
+                stanza = stanzas[i]
+                lconds = stanza['conds']
+                if stanza['template'] is not None:
+                    lconds = stanza['template'][line]
+                for c, v in lconds.items():
+                    conds[c].extend([encoder.conds[c].w2i[v]] * tries)
+                tau.extend([stanza['tau']] * tries)
 
             (hyps, _), scores, hidden, cache = model.sample(
                 encoder,
-                batch=tries,
+                batch=tries * len(running),
                 tau=tau,
-                conds={k: encoder.conds[k].w2i[v] for k, v in conds.items()},
+                conds=dict(conds),
+                hidden=hidden,
                 avoid_unk=avoid_unk,
-                cache=cache, alpha=alpha, theta=theta)
-
-            if not hyps:
-                return
-
-            # sort by score to ensure best is last
-            scores, hyps = zip(*sorted(list(zip(scores, hyps))))
-            scores, hyps = list(scores), list(hyps)
-
-            # downgrade sentences with <unk>
-            c = 0
-            while utils.UNK in hyps[-1] and c < len(hyps):
-                hyps[0], hyps[-1] = hyps[-1], hyps[0]
-                scores[0], scores[-1] = scores[-1], scores[0]
-                c += 1
-
-            # filter out invalid hyps (but always leave last one at least)
-            c = 0
-            while c < len(hyps):
-                hyp = hyps[c].split()
-                if not utils.is_valid(hyp) or \
-                   (prev and not utils.is_valid_pair(hyp, prev)):
-                    hyps.pop(c)
-                    scores.pop(c)
-                else:
-                    c += 1
-
-            if not hyps or sum(scores) == 0.0:
-                return
-
-            # sample from the filtered hyps
-            idx = random.choices(list(range(len(hyps))), scores).pop()
-            # select sampled
-            hyp, score = hyps[idx], scores[idx]
-            # update prev
-            prev = hyp.split()
-
-            # reformat hidden
-            hidden_ = []
-            for h in hidden:
-                if isinstance(h, tuple):
-                    h = h[0][:, idx].repeat(1, tries, 1), \
-                        h[1][:, idx].repeat(1, tries, 1)
-                else:
-                    h = h[:, idx].repeat(1, tries, 1)
-                hidden_.append(h)
-            hidden = hidden_
-
-            # prepare output
-            line = hyp
-            if model.modelname.startswith('RNN'):
-                line = utils.join_syllables(hyp.split())
-            line = utils.detokenize(line)
-
-            text.append({"line": line, "original": hyp, "params": {"score": score}})
+                top_k=top_k, top_p=top_p,
+                cache=cache, alpha=alpha, theta=theta,
+                rhyme_masks=rhyme_masks,
+                mask_syllables=mask_syllables, validate=validate)
+
+            # select a candidate per stanza
+            rows, running_ = [], []
+            for k, i in enumerate(running):
+                stanza = stanzas[i]
+                start = k * tries
+                idx = select_candidate(
+                    hyps[start: start + tries], scores[start: start + tries],
+                    prev=stanza['prev'], validated=validate)
+                if idx is None:
+                    stanza['text'] = None  # failed
+                    continue
+
+                hyp, score = hyps[start + idx], scores[start + idx]
+                # update prev
+                stanza['prev'] = hyp.split()
+
+                # prepare output
+                line_ = hyp
+                if model.modelname.startswith('RNN'):
+                    line_ = utils.join_syllables(hyp.split())
+                line_ = utils.detokenize(line_)
+                stanza['text'].append(
+                    {"line": line_, "original": hyp, "params": {"score": score}})
+
+                if len(stanza['text']) < stanza['nlines']:
+                    rows.extend([start + idx] * tries)
+                    running_.append(i)
+
+            # continue from the hidden state of the selected candidates
+            running = running_
+            if running:
+                rows = torch.tensor(rows, dtype=torch.int64).to(self.device)
+                hidden = torch_utils.select_hidden(hidden, rows)
+
+        samples = []
+        for stanza in stanzas:
+            if stanza['text'] is None:
+                samples.append(None)
+                continue
 
-        return {"id": str(uuid.uuid1())[:8],
+            template = stanza['template']
+            samples.append({
+                "id": str(uuid.uuid1())[:8],
                 "params": {
                     # sampled parameters
-                    "tau": tau,
-                    "nlines": nlines,
-                    "template": template[:nlines] if template else None,
-                    "template_metadata": tmeta,
-                    "conds": None if template is not None else conds,
+                    "tau": stanza['tau'],
+                    "nlines": stanza['nlines'],
+                    "template": template[:stanza['nlines']] if template else None,
+                    "template_metadata": stanza['tmeta'],
+                    "conds": None if template is not None else stanza['conds'],
                     # passed parameters (for reference)
                     "avoid_unk": avoid_unk,
+                    "top_k": top_k,
+                    "top_p": top_p,
                     "tries": tries,
                     "cache_size": cache_size,
                     "alpha": alpha,
-                    "theta": theta
+                    "theta": theta,
+                    "constrain_rhyme": constrain_rhyme,
+                    "mask_syllables": mask_syllables
                 },
                 "model": model.modelname,
-                "text": text}
+                "text": stanza['text']})
+
+        return samples
+
+
+def select_candidate(hyps, scores, prev=None, validated=False):
+    """
+    Sample one of the candidate lines (multinomial over their scores) after
+    filtering out invalid ones (see `utils.is_valid` and `utils.is_valid_pair`
+    with the previous line `prev`). If `validated`, invalid lines already have
+    a score of 0 and `utils.is_valid` is skipped.
+
+    Returns: index of the selected candidate or None if none is left
+    """
+    if not hyps:
+        return
+
+    # sort by score to ensure best is last
+    order = sorted(range(len(hyps)), key=lambda i: (scores[i], hyps[i]))
+
+    # downgrade sentences with <unk>
+    c = 0
+    while utils.UNK in hyps[order[-1]] and c < len(order):
+        order[0], order[-1] = order[-1], order[0]
+        c += 1
+
+    # filter out invalid hyps
+    order = [i for i in order
+             if (validated and scores[i] > 0 or utils.is_valid(hyps[i].split())) and
+             not (prev and not utils.is_valid_pair(hyps[i].split(), prev))]
+
+    if not order or sum(scores[i] for i in order) == 0.0:
+        return
+
+    # sample from the filtered hyps
+    return random.choices(order, [scores[i] for i in order]).pop()
+
+
+def shard_path(path, shard):
+    """
+    >>> shard_path('samples.jsonl', 3)
+    'samples.003.jsonl'
+    """
+    root, ext = os.path.splitext(path)
+    return '{}.{:03d}{}'.format(root, shard, ext)
+
+
+def generate_shard(shard, nsamples, seed, threads, generator_args, opts, outputpath,
+                   batch=1, repfreq=1000):
+    """
+    Generate `nsamples` into the shard `shard` of `outputpath`. Meant to be run in
+    its own process: the generator is loaded inside the worker, torch intra-op
+    threads are limited to `threads` and the RNGs are seeded with `seed`, so that
+    each shard is reproducible. `batch` stanzas are decoded at once (see
+    `Generator.sample_many`).
+
+    Returns: shard, number of samples, elapsed seconds (excluding model loading)
+    """
+    torch.set_num_threads(threads)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    modelpath, templates, datapath, dpath, device = generator_args
+    tsampler = None
+    if templates:
+        tsampler = TemplateStore(templates)
+    elif datapath:
+        tsampler = TemplateSampler(fpath=datapath, dpath=dpath)
+    generator = Generator(modelpath, template_sampler=tsampler, device=device)
+
+    c, start = 0, time.time()
+    with open(shard_path(outputpath, shard), 'w') as f:
+        last = start
+        while c < nsamples:
+            for sample in generator.sample_many(min(batch, nsamples - c), **opts):
+                if sample:
+                    f.write('{}\n'.format(json.dumps(sample)))
+                    c += 1
+                    if c % repfreq == 0:
+                        print("[shard {:03d}] Processed {:>8} items at speed: {:g} items/sec".format(
+                            shard, c, repfreq / (time.time() - last)))
+                        last = time.time()
+
+    return shard, c, time.time() - start
 
 
 if __name__ == '__main__':
@@ -301,43 +479,102 @@ if __name__ == '__main__':
     parser.add_argument('--modelpath', required=True)
     parser.add_argument('--nsamples', type=int, default=100)
     parser.add_argument('--tau_mean', type=float, default=0.8)
+    parser.add_argument('--top_k', type=int, default=0)
+    parser.add_argument('--top_p', type=float, default=1.0)
+    parser.add_argument('--constrain_rhyme', action='store_true',
+                        help='only end lines with words of the rhyme (needs --datapath)')
+    parser.add_argument('--mask_syllables', action='store_true',
+                        help='prevent broken syllable continuations while decoding')
     parser.add_argument('--outputpath', help='/path/to/output file (jsonl)')
     parser.add_argument('--datapath', help='/path/to/data to sample templates')
     parser.add_argument('--dpath', help='/path/to/phonological dict')
+    parser.add_argument('--templates', help='/path/prefix of a compiled `TemplateStore`')
     parser.add_argument('--tries', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=1,
+                        help='number of stanzas decoded at once (with --outputpath)')
     parser.add_argument('--device', default='cpu')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes, each writing a shard of --outputpath')
+    parser.add_argument('--threads', type=int,
+                        help='torch threads per worker (defaults to #cpus / workers)')
+    parser.add_argument('--seed', type=int, help='shard i is seeded with seed + i')
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
 
-    tsampler = None
-    if args.datapath:
-        if not args.dpath:
-            print("`datapath` requires path to phonological dictionary `dpath`")
-            sys.exit(1)
-        tsampler = TemplateSampler(fpath=args.datapath, dpath=args.dpath)
-
-    generator = Generator(args.modelpath, template_sampler=tsampler, device=args.device)
+    if args.datapath and not args.templates and not args.dpath:
+        print("`datapath` requires path to phonological dictionary `dpath`")
+        sys.exit(1)
 
     opts = {'tries': args.tries,
             'avoid_unk': True,
             'cache_size': 0,
             'tau_mean': args.tau_mean,
+            'top_k': args.top_k,
+            'top_p': args.top_p,
+            'constrain_rhyme': args.constrain_rhyme,
+            'mask_syllables': args.mask_syllables,
             'alpha': 0.15,
             'theta': 0.75}
 
+    if args.workers > 1:
+        if not args.outputpath:
+            print("`workers` requires an output file `outputpath`")
+            sys.exit(1)
+        import multiprocessing as mp
+
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        seed = args.seed if args.seed is not None else random.randint(0, 2 ** 31)
+        generator_args = (args.modelpath, args.templates, args.datapath, args.dpath,
+                          args.device)
+        jobs = []
+        for shard in range(args.workers):
+            nsamples = args.nsamples // args.workers
+            nsamples += int(shard < args.nsamples % args.workers)
+            jobs.append((shard, nsamples, seed + shard, threads,
+                         generator_args, opts, args.outputpath, args.batch))
+
+        print("Generating {} items in {} shards ({} threads each, seed {})".format(
+            args.nsamples, args.workers, threads, seed))
+        start = time.time()
+        # spawn (not fork) to avoid inheriting torch's thread pools
+        with mp.get_context('spawn').Pool(args.workers) as pool:
+            results = pool.starmap(generate_shard, jobs)
+        elapsed = time.time() - start
+        for shard, c, shard_elapsed in results:
+            print("{}: {} items at {:g} items/sec".format(
+                shard_path(args.outputpath, shard), c, c / shard_elapsed))
+        total = sum(c for _, c, _ in results)
+        print("Processed {} items in {:g} secs at speed: {:g} items/sec".format(
+            total, elapsed, total / elapsed))
+        sys.exit(0)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    tsampler = None
+    if args.templates:
+        tsampler = TemplateStore(args.templates)
+    elif args.datapath:
+        tsampler = TemplateSampler(fpath=args.datapath, dpath=args.dpath)
+
+    generator = Generator(args.modelpath, template_sampler=tsampler, device=args.device)
+
     c, repfreq = 0, 1000
     if args.outputpath:
         with open(args.outputpath, 'w') as f:
             start = time.time()
             while c < args.nsamples:
-                sample = generator.sample(**opts)
-                if sample:
-                    f.write('{}\n'.format(json.dumps(sample)))
-                    c += 1
-                if c % repfreq == 0:
-                    print("Processed {:>8} items at speed: {:g} items/sec".format(
-                        c, repfreq / (time.time() - start)))
-                    start = time.time()
+                for sample in generator.sample_many(min(args.batch, args.nsamples - c), **opts):
+                    if sample:
+                        f.write('{}\n'.format(json.dumps(sample)))
+                        c += 1
+                        if c % repfreq == 0:
+                            print("Processed {:>8} items at speed: {:g} items/sec".format(
+                                c, repfreq / (time.time() - start)))
+                            start = time.time()
     else:
         while c < args.nsamples:
             sample = generator.sample(**opts)
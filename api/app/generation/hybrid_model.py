@@ -1,7 +1,6 @@
 
 import math
 import random
-import collections
 import time
 import itertools
 
@@ -15,6 +14,9 @@ from .model import RNNLanguageModel
 
 
 class HybridLanguageModel(RNNLanguageModel):
+    # the word-level rnn feeds the char-level decoder instead of a projection
+    has_step_module = False
+
     def __init__(self, encoder, layers, wemb_dim, cemb_dim, hidden_dim, cond_dim,
                  dropout=0.0):
 
@@ -26,6 +28,12 @@ class HybridLanguageModel(RNNLanguageModel):
         self.dropout = dropout
         self.modelname = self.get_modelname()
         super(RNNLanguageModel, self).__init__()
+        # char-to-word lookup used by `sample` (built on demand, see `utils.CharTrie`)
+        self.char_trie = None
+        # multi-layer copy of `self.rnn` used at inference, see `pack_rnn`
+        self.packed_rnn = None
+        # always None: there is no compiled step (see `has_step_module`)
+        self.step_fn = None
 
         wvocab = encoder.word.size()
         cvocab = encoder.char.size()
@@ -109,15 +117,20 @@ class HybridLanguageModel(RNNLanguageModel):
         outs = embs
         hidden_ = []
         hidden = hidden or [None] * len(self.rnn)
-        for l, rnn in enumerate(self.rnn):
-            outs, h_ = rnn(outs, hidden[l])
-            if l != len(self.rnn) - 1:
-                outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
-                # dropout!: hidden dropout (dropouth)
-                outs = torch_utils.sequential_dropout(
-                    outs, self.dropout, self.training)
-                outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
-            hidden_.append(h_)
+        if self.packed_rnn is not None:
+            # inference: run all layers with a single call (see `pack_rnn`)
+            outs, hidden_ = self.run_rnn(outs, self.pack_hidden(hidden))
+            hidden_ = self.unpack_hidden(hidden_)
+        else:
+            for l, rnn in enumerate(self.rnn):
+                outs, h_ = rnn(outs, hidden[l])
+                if l != len(self.rnn) - 1:
+                    outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
+                    # dropout!: hidden dropout (dropouth)
+                    outs = torch_utils.sequential_dropout(
+                        outs, self.dropout, self.training)
+                    outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
+                hidden_.append(h_)
         outs, _ = nn.utils.rnn.pad_packed_sequence(outs)
         outs = outs[:, unsort]
         hidden = hidden_
@@ -181,9 +194,11 @@ class HybridLanguageModel(RNNLanguageModel):
         return math.log2(math.e) * loss
 
     def sample(self, encoder, nsyms=50, max_sym_len=10, batch=1,
-               conds=None, hidden=None, tau=1.0, cache=None, **kwargs):
+               conds=None, hidden=None, tau=1.0, cache=None, top_k=0, top_p=1.0,
+               **kwargs):
         """
-        Generate stuff
+        Generate stuff (`conds` and `tau` can be given per row as lists of `batch`
+        values, see `RNNLanguageModel.sample`)
         """
         # batch
         if hidden is not None:
@@ -193,6 +208,8 @@ class HybridLanguageModel(RNNLanguageModel):
                 batch = hidden[0].size(1)
         else:
             hidden = [None] * len(self.rnn)
+        # stacked layers (if packed) are run with a single call, see `run_rnn`
+        hidden = self.pack_hidden(hidden)
 
         # sample conditions if needed
         conds, bconds = conds or {}, []
@@ -201,10 +218,18 @@ class HybridLanguageModel(RNNLanguageModel):
             if c not in conds:
                 conds[c] = random.choice(list(encoder.conds[c].w2i.values()))
             # compute embedding
-            bcond = torch.tensor([conds[c]] * batch, dtype=torch.int64).to(self.device)
+            bcond = torch_utils.batch_values(conds[c], batch).to(self.device)
             bcond = self.conds[c](bcond)
             bconds.append(bcond.expand(1, batch, -1))
 
+        # per-row temperature
+        if isinstance(tau, (list, tuple)):
+            tau = torch_utils.batch_values(tau, batch, dtype=torch.float).to(self.device)
+
+        if self.char_trie is None:
+            self.char_trie = utils.CharTrie(encoder.word, encoder.char)
+        trie = self.char_trie.to(self.device)
+
         word = [encoder.word.bos] * batch  # (batch)
         word = torch.tensor(word, dtype=torch.int64).to(self.device)
         nwords = [1] * batch    # same nwords per step
@@ -213,15 +238,23 @@ class HybridLanguageModel(RNNLanguageModel):
         char = torch.tensor(char, dtype=torch.int64).to(self.device).t()
         nchars = [3] * batch
 
-        output = collections.defaultdict(list)
-        mask = torch.ones(batch, dtype=torch.int64).to(self.device)
-        scores = 0
-        running = torch.ones_like(mask)
+        # (nsyms x max_sym_len x batch) char ids of each generated word,
+        # (nsyms x batch) their lengths and (batch) number of words per row
+        output = torch.zeros(nsyms, max_sym_len, batch, dtype=torch.int64).to(self.device)
+        wlengths = torch.zeros(nsyms, batch, dtype=torch.int64).to(self.device)
+        lengths = torch.zeros(batch, dtype=torch.int64).to(self.device)
+        scores = torch.zeros(batch).to(self.device)
+        running = torch.ones(batch, dtype=torch.int64).to(self.device)
+        # batch indices of the rows in the working batch (finished rows are dropped)
+        active = torch.arange(batch, dtype=torch.int64).to(self.device)
+        output_hidden = None
+        # (max_sym_len x 1) char positions used to build the next char-level input
+        positions = torch.arange(1, max_sym_len + 1).unsqueeze(1).to(self.device)
 
         with torch.no_grad():
-            for _ in range(nsyms):
+            for step in range(nsyms):
                 # check if done
-                if sum(running).item() == 0:
+                if len(active) == 0:
                     break
 
                 # embeddings
@@ -231,20 +264,19 @@ class HybridLanguageModel(RNNLanguageModel):
                 if conds:
                     embs = torch.cat([embs, *bconds], -1)
 
-                outs = embs
-                hidden_ = []
-                for l, rnn in enumerate(self.rnn):
-                    outs, h_ = rnn(outs, hidden[l])
-                    hidden_.append(h_)
-                hidden = torch_utils.update_hidden(hidden, hidden_, mask)
+                outs, hidden_ = self.run_rnn(embs, hidden)
+                hidden = torch_utils.update_hidden(hidden, hidden_, running)
 
                 # char-level
-                cinp = torch.tensor([encoder.char.bos] * batch).to(self.device)
+                cinp = torch.tensor([encoder.char.bos] * len(active)).to(self.device)
                 chidden = None
-                coutput = collections.defaultdict(list)
-                cmask = torch.ones_like(mask)
+                cmask = torch.ones_like(running)
+                # (max_sym_len x batch) sampled char ids and number of valid ids per row
+                coutput = torch.zeros(
+                    max_sym_len, len(active), dtype=torch.int64).to(self.device)
+                clengths = torch.zeros(len(active), dtype=torch.int64).to(self.device)
 
-                for _ in range(max_sym_len):
+                for cstep in range(max_sym_len):
                     # check if done
                     if sum(cmask).item() == 0:
                         break
@@ -256,8 +288,10 @@ class HybridLanguageModel(RNNLanguageModel):
                     logits = self.proj(couts).squeeze(0)
                     # sample
                     logprob = F.log_softmax(logits, dim=-1)
+                    slogits = torch_utils.process_logits(
+                        logprob, tau=tau, top_k=top_k, top_p=top_p)
                     # (1 x batch) -> (batch)
-                    cinp = (logprob / tau).exp().multinomial(1)
+                    cinp = F.softmax(slogits, dim=-1).multinomial(1)
                     score = logprob.gather(1, cinp)
                     cinp, score = cinp.squeeze(1), score.squeeze(1)
 
@@ -268,32 +302,60 @@ class HybridLanguageModel(RNNLanguageModel):
                     running = running * cinp.ne(encoder.char.eol).long()
 
                     # accumulate
-                    scores += score * cmask.float()
-                    for idx, (active, w) in enumerate(zip(cmask.tolist(), cinp.tolist())):
-                        if active:
-                            coutput[idx].append(encoder.char.i2w[w])
-
-                # get word-level and character-level input
-                word, char = [], []
-                for idx, active in enumerate(running.tolist()):
-                    # if not active, we still need char and word input for next step
-                    w = '<dummy>'
-                    if active:
-                        w = ''.join(coutput.get(idx, []))  # might be empty
-                        # append to global output                    
-                        output[idx].append(w)
-                    word.append(encoder.word.transform_item(w))
-                    char.append(encoder.char.transform(w))
-
-                # to batch
-                word = torch.tensor(word, dtype=torch.int64).to(self.device)
-                char, nchars = utils.get_batch(char, encoder.char.pad, self.device)
-
-        # transform output to list-batch of hyps
-        output = [output[i] for i in range(len(output))]
+                    scores.index_add_(0, active, score * cmask.float())
+                    coutput[cstep] = cinp
+                    clengths += cmask
+
+                # store the words of the rows that are still running
+                output[step].index_copy_(1, active, coutput)
+                wlengths[step].index_copy_(0, active, clengths)
+                lengths.index_add_(0, active, running)
+
+                # get word-level and character-level input: <bos> chars <eos> <pad>...
+                word = trie.lookup(coutput, clengths)
+                char = torch.full((max_sym_len + 2, len(active)), encoder.char.pad,
+                                  dtype=torch.int64).to(self.device)
+                char[0] = encoder.char.bos
+                char[1:-1] = torch.where(positions <= clengths, coutput, char[1:-1])
+                char.scatter_(0, (clengths + 1).unsqueeze(0), encoder.char.eos)
+                nchars = clengths + 2
+
+                # drop finished rows from the working batch
+                nrunning = running.sum().item()
+                if nrunning < len(active):
+                    keep, done = running.nonzero().view(-1), (1 - running).nonzero().view(-1)
+                    output_hidden = torch_utils.scatter_hidden(
+                        output_hidden, torch_utils.select_hidden(hidden, done),
+                        active[done], batch)
+                    hidden = torch_utils.select_hidden(hidden, keep)
+                    active, running = active[keep], running[keep]
+                    bconds = [bcond[:, keep] for bcond in bconds]
+                    if torch.is_tensor(tau):
+                        tau = tau[keep]
+                    word, char, nchars = word[keep], char[:, keep], nchars[keep]
+                    if len(keep) == 0:
+                        break
+
+                nwords = [1] * nrunning
+
+            # write back hidden state of unfinished rows
+            if len(active) > 0 and hidden[0] is not None:
+                output_hidden = torch_utils.scatter_hidden(
+                    output_hidden, hidden, active, batch)
+
+        if output_hidden is not None:
+            hidden = output_hidden
+        hidden = self.unpack_hidden(hidden)
+
+        # transform output to list-batch of hyps (strings are only built here)
+        i2c = encoder.char.i2w
+        output, wlengths = output.permute(2, 0, 1).tolist(), wlengths.t().tolist()
+        output = [[''.join(i2c[c] for c in cs[:clen])
+                   for cs, clen in zip(output[i][:n], wlengths[i][:n])]
+                  for i, n in enumerate(lengths.tolist())]
 
         # prepare output
-        conds = {c: encoder.conds[c].i2w[cond] for c, cond in conds.items()}
+        conds = encoder.decode_conds(conds)
         hyps, probs = [], []
         for hyp, score in zip(output, scores):
             try:
@@ -305,6 +367,105 @@ class HybridLanguageModel(RNNLanguageModel):
 
         return (hyps, conds), probs, hidden, cache
 
+    def beam_search(self, encoder, nsyms=50, max_sym_len=10, **kwargs):
+        """
+        Beam search over characters (see `RNNLanguageModel.beam_search`). `nsyms`
+        is the maximum number of words, `max_sym_len` the maximum word length.
+        """
+        return super().beam_search(
+            encoder, nsyms=nsyms * (max_sym_len + 1), max_sym_len=max_sym_len, **kwargs)
+
+    def beam_word_step(self, word, cemb, bconds, hidden):
+        """
+        Run the word-level rnn for one step
+        """
+        n = len(word)
+        embs = [self.wembs(word.unsqueeze(0)), cemb]
+        embs = torch.cat(embs + [bcond.expand(1, n, -1) for bcond in bconds], -1)
+
+        return self.run_rnn(embs, hidden)
+
+    def beam_setup(self, encoder, conds, hidden, max_sym_len=10, **kwargs):
+        state = super().beam_setup(encoder, conds, hidden)
+        # read <l>
+        outs, hidden = self.beam_word_step(
+            state['word'], state['cemb'], state['bconds'], state['hidden'])
+
+        return {"eos": encoder.char.eol,
+                "max_sym_len": max_sym_len,
+                "hidden": hidden,
+                "bconds": state['bconds'],
+                # (1 x n x hidden_dim) word-level output for the current word
+                "outs": outs,
+                "chidden": None,
+                "cinp": torch.tensor([encoder.char.bos]).to(self.device),
+                # chars generated so far for the current word
+                "chars": [[]]}
+
+    def beam_step(self, encoder, state):
+        cemb = torch.cat([self.cout_embs(state['cinp'].unsqueeze(0)), state['outs']], -1)
+        couts, state['chidden'] = self.cout_rnn(cemb, state['chidden'])
+        logprob = F.log_softmax(self.proj(couts.squeeze(0)), dim=-1)
+
+        # force end of word for words that reached the maximum length
+        full = [i for i, chars in enumerate(state['chars'])
+                if len(chars) >= state['max_sym_len']]
+        if full:
+            full = torch.tensor(full).to(self.device)
+            logprob.index_fill_(0, full, -float('inf'))
+            logprob[full, encoder.char.eos] = 0.0
+
+        return logprob
+
+    def beam_update(self, encoder, state, source, token):
+        n = len(source)
+        state['hidden'] = torch_utils.select_hidden(state['hidden'], source)
+        state['outs'] = state['outs'].index_select(1, source)
+        state['chidden'] = tuple(torch_utils.select_hidden([state['chidden']], source)[0])
+        state['cinp'] = token.clone()
+
+        chars, ends = [list(state['chars'][i]) for i in source.tolist()], []
+        for idx, c in enumerate(token.tolist()):
+            if c == encoder.char.eos:
+                ends.append(idx)
+            else:
+                chars[idx].append(c)
+
+        # finished words: run the word-level rnn and restart the char-level rnn
+        if ends:
+            words = [''.join(encoder.char.i2w[c] for c in chars[idx]) for idx in ends]
+            for idx in ends:
+                chars[idx] = []
+            word = [encoder.word.transform_item(w) for w in words]
+            word = torch.tensor(word, dtype=torch.int64).to(self.device)
+            char, nchars = utils.get_batch(
+                [encoder.char.transform(w) for w in words], encoder.char.pad, self.device)
+            ends = torch.tensor(ends).to(self.device)
+            outs, hidden = self.beam_word_step(
+                word, self.embed_chars(char, nchars, [1] * len(nchars)),
+                state['bconds'], torch_utils.select_hidden(state['hidden'], ends))
+            state['outs'].index_copy_(1, ends, outs)
+            state['hidden'] = torch_utils.scatter_hidden(state['hidden'], hidden, ends, n)
+            for h in state['chidden']:
+                h.index_fill_(1, ends, 0.0)
+            state['cinp'].index_fill_(0, ends, encoder.char.bos)
+
+        state['chars'] = chars
+
+        return state
+
+    def beam_decode(self, encoder, seq):
+        # split on end of word (last unfinished word is dropped)
+        words, chars = [], []
+        for c in seq:
+            if c == encoder.char.eos:
+                words.append(''.join(encoder.char.i2w[c_] for c_ in chars))
+                chars = []
+            else:
+                chars.append(c)
+
+        return words
+
 
 if __name__ == '__main__':
     import argparse
@@ -1,10 +1,10 @@
 
 import json
 import os
-import collections
 import random
 import math
 import time
+import zipfile
 from datetime import datetime
 
 import torch
@@ -17,7 +17,34 @@ from . import utils
 from . import torch_utils
 
 
+class DecodeStep(nn.Module):
+    """
+    Single decoding step (input embedding, multi-layer rnn and output
+    distribution) written so that it can be compiled with `torch.jit.script`
+    """
+    def __init__(self, embs, rnn, proj):
+        super().__init__()
+        self.embs = embs
+        self.rnn = rnn
+        self.proj = proj
+
+    def forward(self, word, cemb, conds, h, c):
+        """
+        word: (batch), cemb: (1 x batch x cemb_dim), conds: (1 x batch x cond_dims)
+        h, c: (layers x batch x hidden_dim)
+
+        Returns: logprob (batch x vocab), h, c, outs (batch x hidden_dim)
+        """
+        embs = torch.cat([self.embs(word.unsqueeze(0)), cemb, conds], -1)
+        outs, (h, c) = self.rnn(embs, (h, c))
+        outs = outs.squeeze(0)
+        return F.log_softmax(self.proj(outs), dim=-1), h, c, outs
+
+
 class RNNLanguageModel(nn.Module):
+    # whether the decoding step can be run as a `DecodeStep` (see `compile_step`)
+    has_step_module = True
+
     def __init__(self, encoder, layers, wemb_dim, cemb_dim, hidden_dim, cond_dim,
                  dropout=0.0, tie_weights=False):
 
@@ -31,6 +58,13 @@ class RNNLanguageModel(nn.Module):
         self.modelname = self.get_modelname()
         super().__init__()
 
+        # (vocab x cemb_dim) table of char-level word embeddings, see `embed_vocab`
+        self.vocab_cembs = None
+        # multi-layer copy of `self.rnn` used at inference, see `pack_rnn`
+        self.packed_rnn = None
+        # compiled `DecodeStep` used by `step`, see `compile_step`
+        self.step_fn = None
+
         wvocab = encoder.word.size()
         cvocab = encoder.char.size()
 
@@ -107,17 +141,193 @@ class RNNLanguageModel(nn.Module):
             encoder.to_json(fpath + '.encoder.json')
 
     @classmethod
-    def load(cls, modelname, encoder):
-        encoder = encoder.from_json(modelname + '.encoder.json')
+    def load(cls, modelname, encoder, mmap=False):
+        """
+        Load model and encoder. If `mmap`, the weights are memory-mapped from the
+        checkpoint instead of being copied, so that processes loading the same
+        model share them through the page cache. Legacy (non-zip) checkpoints
+        can't be memory-mapped and are loaded normally.
+        """
+        encoder = encoder.load(modelname)
 
         with open(modelname + '.params.json') as f:
             params = json.loads(f.read())
             inst = cls(encoder, *params['args'], **params['kwargs'])
-        inst.load_state_dict(torch.load(modelname + '.pt'))
+        if mmap and not zipfile.is_zipfile(modelname + '.pt'):
+            print("Can't memory-map legacy checkpoint {}.pt, resave it with "
+                  "torch.save to share its weights".format(modelname))
+            mmap = False
+        if mmap:
+            state_dict = torch.load(modelname + '.pt', map_location='cpu', mmap=True)
+            inst.load_state_dict(state_dict, assign=True)
+        else:
+            inst.load_state_dict(torch.load(modelname + '.pt'))
         inst.modelname = os.path.basename(modelname)
 
         return inst, encoder
 
+    def load_state_dict(self, *args, **kwargs):
+        # precomputed embeddings are stale after reloading the weights
+        self.vocab_cembs = None
+        self.__dict__['packed_rnn'] = None
+        self.__dict__['step_fn'] = None
+        return super().load_state_dict(*args, **kwargs)
+
+    def train(self, mode=True):
+        # weights are going to change, precomputed embeddings will be stale
+        if mode:
+            self.vocab_cembs = None
+            self.__dict__['packed_rnn'] = None
+            self.__dict__['step_fn'] = None
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        # the packed rnn and the compiled step aren't registered as submodules
+        for name in ('packed_rnn', 'step_fn'):
+            if getattr(self, name, None) is not None:
+                getattr(self, name)._apply(fn, *args, **kwargs)
+        return super()._apply(fn, *args, **kwargs)
+
+    def pack_rnn(self):
+        """
+        Pack the stack of single-layer rnns in `self.rnn` into one multi-layer
+        rnn (sharing their weights), so that inference runs all layers with a
+        single call. The packed rnn isn't registered as a submodule (the
+        checkpoint format is unchanged) and it is dropped when weights are
+        reloaded or the model is switched to training mode. Returns None if the
+        layers can't be packed.
+        """
+        first, packed = self.rnn[0], None
+        compatible = len(self.rnn) > 1 and all(
+            type(rnn) is type(first) and rnn.num_layers == 1 and not rnn.bidirectional
+            and rnn.hidden_size == first.hidden_size and rnn.bias == first.bias
+            and (l == 0 or rnn.input_size == first.hidden_size)
+            for l, rnn in enumerate(self.rnn))
+
+        if compatible:
+            packed = type(first)(first.input_size, first.hidden_size,
+                                 num_layers=len(self.rnn), bias=first.bias)
+            # share the weights of the layers instead of copying them
+            for l, rnn in enumerate(self.rnn):
+                for name, p in rnn.named_parameters():
+                    setattr(packed, name[:-1] + str(l), p)
+            packed.to(self.device).eval()
+
+        self.__dict__['packed_rnn'] = packed
+
+        return packed
+
+    def pack_hidden(self, hidden):
+        """
+        Transform a per-layer hidden state into the format expected by `run_rnn`
+        """
+        if self.packed_rnn is None:
+            return hidden
+        return torch_utils.stack_hidden(hidden)
+
+    def unpack_hidden(self, hidden):
+        """
+        Inverse of `pack_hidden`
+        """
+        if self.packed_rnn is None:
+            return hidden
+        return torch_utils.split_hidden(hidden, len(self.rnn))
+
+    def run_rnn(self, inp, hidden):
+        """
+        Run the rnn layers over `inp` without inter-layer dropout. `hidden` must
+        be in the format returned by `pack_hidden`, and so is the output hidden.
+        """
+        if self.packed_rnn is not None:
+            outs, hidden = self.packed_rnn(inp, hidden[0])
+            return outs, [hidden]
+
+        outs, hidden_ = inp, []
+        for l, rnn in enumerate(self.rnn):
+            outs, h_ = rnn(outs, hidden[l])
+            hidden_.append(h_)
+
+        return outs, hidden_
+
+    def quantize(self, dtype=torch.qint8):
+        """
+        Apply dynamic quantization (weights stored as int8, activations quantized
+        on the fly) to all rnns and linear layers, including the packed rnn if
+        present. Inference only and cpu only; call it after `pack_rnn` and before
+        `embed_vocab`.
+        """
+        modules = {nn.LSTM, nn.Linear}
+        torch.quantization.quantize_dynamic(self, modules, dtype=dtype, inplace=True)
+        self.__dict__['step_fn'] = None
+        if self.packed_rnn is not None:
+            # the root module isn't swapped by `quantize_dynamic`, wrap it
+            packed = nn.Sequential(self.packed_rnn)
+            torch.quantization.quantize_dynamic(packed, modules, dtype=dtype, inplace=True)
+            self.__dict__['packed_rnn'] = packed[0]
+        self.vocab_cembs = None
+
+        return self
+
+    def get_input_embs(self):
+        """
+        Embedding of the input symbols of the rnn
+        """
+        return self.wembs
+
+    def get_step_module(self):
+        """
+        Modules run by `step` as a `DecodeStep`
+        """
+        return DecodeStep(self.get_input_embs(), self.get_single_rnn(), self.proj)
+
+    def get_single_rnn(self):
+        """
+        The rnn layers as a single (multi-layer) rnn, see `pack_rnn`
+        """
+        if self.packed_rnn is not None:
+            return self.packed_rnn
+        if len(self.rnn) == 1:
+            return self.rnn[0]
+        raise ValueError("Stacked rnn layers must be packed first, see `pack_rnn`")
+
+    def compile_step(self):
+        """
+        Compile the decoding step with TorchScript and use it in `step`. The
+        scripted module holds the model parameters (no copy of the weights). Like
+        `packed_rnn`, the compiled step is dropped when weights are reloaded or
+        the model is switched to training mode.
+        """
+        if not self.has_step_module:
+            raise ValueError("Compiled decoding step is not available for {}".format(
+                type(self).__name__))
+        step_fn = torch.jit.script(self.get_step_module().eval())
+        self.__dict__['step_fn'] = step_fn
+
+        return step_fn
+
+    def step(self, word, cemb, conds, hidden):
+        """
+        Run one decoding step (compiled if `compile_step` was called)
+
+        - word : (batch), cemb : (1 x batch x cemb_dim), conds : (1 x batch x *)
+        - hidden : hidden state in the format returned by `pack_hidden`
+
+        Returns: logprob (batch x vocab), hidden, outs (batch x hidden_dim)
+        """
+        if self.step_fn is not None:
+            if hidden[0] is None:
+                rnn = self.get_single_rnn()
+                h = torch.zeros(rnn.num_layers, len(word), rnn.hidden_size).to(self.device)
+                hidden = [(h, h)]
+            logprob, h, c, outs = self.step_fn(word, cemb, conds, *hidden[0])
+            return logprob, [(h, c)], outs
+
+        embs = torch.cat([self.get_input_embs()(word.unsqueeze(0)), cemb, conds], -1)
+        outs, hidden = self.run_rnn(embs, hidden)
+        outs = outs.squeeze(0)
+
+        return F.log_softmax(self.proj(outs), dim=-1), hidden, outs
+
     def get_modelname(self):
         return "{}.{}".format(
             type(self).__name__, datetime.now().strftime("%Y-%m-%d+%H:%M:%S"))
@@ -137,6 +347,29 @@ class RNNLanguageModel(nn.Module):
 
         return cembs
 
+    def embed_vocab(self, encoder, batch_size=1000):
+        """
+        Run the char-level embedder once over the full word vocabulary and store
+        the output as a (vocab x cemb_dim) table, so that sampling can look up the
+        char-level embedding of the previous word instead of recomputing it.
+        The table is invalidated when weights are reloaded or the model is
+        switched back to training mode.
+        """
+        words = [encoder.word.i2w[i] for i in range(encoder.word.size())]
+        table = []
+
+        with torch.no_grad():
+            for start in range(0, len(words), batch_size):
+                char = [encoder.char.transform(w)
+                        for w in words[start:start+batch_size]]
+                char, nchars = utils.get_batch(char, encoder.char.pad, self.device)
+                # (1 x batch x cemb_dim) -> (batch x cemb_dim)
+                table.append(self.embed_chars(char, nchars, [1] * len(nchars))[0])
+
+        self.vocab_cembs = torch.cat(table, 0)
+
+        return self.vocab_cembs
+
     def forward(self, word, nwords, char, nchars, conds, hidden=None, project=True):
         # dropout!: embedding dropout (dropoute), not implemented
         # (seq x batch x wemb_dim)
@@ -162,15 +395,20 @@ class RNNLanguageModel(nn.Module):
         outs = embs
         hidden_ = []
         hidden = hidden or [None] * len(self.rnn)
-        for l, rnn in enumerate(self.rnn):
-            outs, h_ = rnn(outs, hidden[l])
-            if l != len(self.rnn) - 1:
-                outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
-                # dropout!: hidden dropout (dropouth)
-                outs = torch_utils.sequential_dropout(
-                    outs, self.dropout, self.training)
-                outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
-            hidden_.append(h_)
+        if self.packed_rnn is not None:
+            # inference: run all layers with a single call (see `pack_rnn`)
+            outs, hidden_ = self.run_rnn(outs, self.pack_hidden(hidden))
+            hidden_ = self.unpack_hidden(hidden_)
+        else:
+            for l, rnn in enumerate(self.rnn):
+                outs, h_ = rnn(outs, hidden[l])
+                if l != len(self.rnn) - 1:
+                    outs, lengths = nn.utils.rnn.pad_packed_sequence(outs)
+                    # dropout!: hidden dropout (dropouth)
+                    outs = torch_utils.sequential_dropout(
+                        outs, self.dropout, self.training)
+                    outs = nn.utils.rnn.pack_padded_sequence(outs, lengths)
+                hidden_.append(h_)
         outs, _ = nn.utils.rnn.pad_packed_sequence(outs)
         outs = outs[:, unsort]
         hidden = hidden_
@@ -208,10 +446,26 @@ class RNNLanguageModel(nn.Module):
 
     def sample(self, encoder, nsyms=100, batch=1,
                conds=None, hidden=None, tau=1.0,
-               cache=None, alpha=0.0, theta=0.0,
-               avoid_unk=False):
+               cache=None, alpha=0.0, theta=0.0, penalty=None, npenalty=None,
+               avoid_unk=False, top_k=0, top_p=1.0, repetition_penalty=1.0,
+               rhyme_masks=None, mask_syllables=False, validate=False):
         """
         Generate stuff
+
+        Sampling uses the distribution after `torch_utils.process_logits`
+        (temperature `tau`, `top_k`/`top_p` truncation, <unk> suppression if
+        `avoid_unk` and `repetition_penalty` over the words of each line).
+        If a `cache` is given, `penalty` and `npenalty` control the closeness
+        penalty of `Cache.interpolate`. If `rhyme_masks` are given (see
+        `utils.get_rhyme_masks`), lines can only end with a word of the rhyme
+        condition: reverse models mask the first step, other models only allow
+        </s> after such a word. If `mask_syllables`, tokens that would break the
+        syllabification of the line are masked (see `utils.TokenFlags.get_mask`)
+        and, if `validate`, invalid lines (see `utils.TokenFlags.is_valid`) get
+        a score of 0.
+
+        Conditions (`conds`) and `tau` can be given per row as lists of `batch`
+        values, e.g. to decode independent stanzas in the same batch.
         """
         # batch
         if hidden is not None:
@@ -221,6 +475,8 @@ class RNNLanguageModel(nn.Module):
                 batch = hidden[0].size(1)
         else:
             hidden = [None] * len(self.rnn)
+        # stacked layers (if packed) are run with a single call, see `run_rnn`
+        hidden = self.pack_hidden(hidden)
 
         # sample conditions if needed
         conds, bconds = conds or {}, []
@@ -229,9 +485,23 @@ class RNNLanguageModel(nn.Module):
             if c not in conds:
                 conds[c] = random.choice(list(encoder.conds[c].w2i.values()))
             # compute embedding
-            bcond = torch.tensor([conds[c]] * batch, dtype=torch.int64).to(self.device)
+            bcond = torch_utils.batch_values(conds[c], batch).to(self.device)
             bcond = self.conds[c](bcond)
             bconds.append(bcond.expand(1, batch, -1))
+        # (1 x batch x cond_dim * nconds)
+        bconds = torch.cat(bconds, -1) if bconds else torch.zeros(1, batch, 0).to(self.device)
+
+        # per-row temperature
+        if isinstance(tau, (list, tuple)):
+            tau = torch_utils.batch_values(tau, batch, dtype=torch.float).to(self.device)
+
+        # (vocab) or (batch x vocab) words that can end the line with the rhyme
+        end_mask = None
+        if rhyme_masks is not None and 'rhyme' in conds:
+            rhyme = conds['rhyme']
+            if isinstance(rhyme, (list, tuple)):
+                rhyme = torch.tensor(rhyme, dtype=torch.int64)
+            end_mask = rhyme_masks[rhyme].to(self.device)
 
         word = [encoder.word.bos] * batch  # (batch)
         word = torch.tensor(word, dtype=torch.int64).to(self.device)
@@ -241,53 +511,78 @@ class RNNLanguageModel(nn.Module):
         char = torch.tensor(char, dtype=torch.int64).to(self.device).t()
         nchars = [3] * batch
 
-        output = collections.defaultdict(list)
+        # (nsyms x batch) sampled word ids and number of valid ids per row
+        output = torch.zeros(nsyms, batch, dtype=torch.int64).to(self.device)
+        lengths = torch.zeros(batch, dtype=torch.int64).to(self.device)
         mask = torch.ones(batch, dtype=torch.int64).to(self.device)
-        scores = 0
+        scores = torch.zeros(batch).to(self.device)
+        # batch indices of the rows in the working batch (finished rows are
+        # dropped as they emit EOS unless a cache is used) and final hidden state
+        active = torch.arange(batch, dtype=torch.int64).to(self.device)
+        output_hidden = None
+
+        # syllabification flags of the vocabulary
+        flags = None
+        if mask_syllables or validate:
+            flags = encoder.flags.to(self.device)
+
+        # precomputed char-level embeddings for the vocabulary (if available)
+        vocab_cembs = None
+        if self.vocab_cembs is not None and not self.training:
+            vocab_cembs = self.vocab_cembs.to(self.device)
 
         with torch.no_grad():
-            for _ in range(nsyms):
+            # (1 x batch x cemb_dim)
+            cemb = self.embed_chars(char, nchars, nwords)
+
+            for step in range(nsyms):
                 # check if done
-                if sum(mask).item() == 0:
+                if len(active) == 0:
                     break
 
-                # embeddings
-                wemb = self.wembs(word.unsqueeze(0))
-                cemb = self.embed_chars(char, nchars, nwords)
-                embs = torch.cat([wemb, cemb], -1)
-                if conds:
-                    embs = torch.cat([embs, *bconds], -1)
-
-                # rnn
-                outs = embs
-                hidden_ = []
-                for l, rnn in enumerate(self.rnn):
-                    outs, h_ = rnn(outs, hidden[l])
-                    hidden_.append(h_)
-                # (1 x batch x hid) -> (batch x hid)
-                outs = outs.squeeze(0)
+                # (batch x vocab), (batch x hid)
+                logprob, hidden_, outs = self.step(word, cemb, bconds, hidden)
                 # only update hidden for active instances
                 hidden = torch_utils.update_hidden(hidden, hidden_, mask)
 
-                # get logits
-                logits = self.proj(outs)
-
-                # - set unk to least value (might still return unk in high-entropy cases)
-                if avoid_unk:
-                    logits[:, encoder.word.unk] = logits.min(dim=1)[0]
-
-                # - mix with cache
+                # mix with cache (log-probabilities are normalized logits)
                 if cache and cache.stored > 0:
                     logprob = cache.interpolate(
-                        outs, logits, alpha, theta
+                        outs, logprob, alpha, theta,
+                        penalty=penalty, npenalty=npenalty
                     ).add(1e-8).log()
 
-                # - normal case
-                else:
-                    logprob = F.log_softmax(logits, dim=-1)
+                # rhyme constraint
+                allowed = None
+                if end_mask is not None and encoder.reverse:
+                    # the first generated word is the last word of the line
+                    allowed = end_mask if step == 0 else None
+                elif end_mask is not None:
+                    allowed = torch.ones_like(logprob, dtype=torch.bool)
+                    if end_mask.dim() == 1:
+                        allowed[:, encoder.word.eos] = end_mask[word]
+                    else:
+                        allowed[:, encoder.word.eos] = end_mask.gather(
+                            1, word.unsqueeze(1)).squeeze(1)
+
+                # syllabification constraint
+                if mask_syllables:
+                    smask = flags.get_mask(
+                        word, step == 0, encoder.reverse, encoder.word.eos)
+                    allowed = smask if allowed is None else smask & allowed
+                    # don't leave rows without candidates
+                    allowed = allowed | ~allowed.any(1, keepdim=True)
 
                 # sample
-                word = (logprob / tau).exp().multinomial(1)
+                prev = None
+                if repetition_penalty != 1.0:
+                    prev = output[:step].index_select(1, active).t()
+                slogits = torch_utils.process_logits(
+                    logprob, tau=tau, top_k=top_k, top_p=top_p,
+                    unk=encoder.word.unk if avoid_unk else None,
+                    prev=prev, repetition_penalty=repetition_penalty,
+                    allowed=allowed)
+                word = F.softmax(slogits, dim=-1).multinomial(1)
                 score = logprob.gather(1, word)
                 word, score = word.squeeze(1), score.squeeze(1)
 
@@ -299,24 +594,61 @@ class RNNLanguageModel(nn.Module):
                     cache = cache.add(outs.unsqueeze(0), word.unsqueeze(0))
 
                 # accumulate
-                scores += score * mask.float()
-                for idx, (active, w) in enumerate(zip(mask.tolist(), word.tolist())):
-                    if active:
-                        output[idx].append(encoder.word.i2w[w])
+                scores.index_add_(0, active, score * mask.float())
+                output[step].index_copy_(0, active, word)
+                lengths.index_add_(0, active, mask)
+
+                # drop finished rows from the working batch (cache is shared
+                # along the batch, so rows must be kept if a cache is used)
+                nactive = mask.sum().item()
+                if cache is not None and nactive == 0:
+                    break
+                if cache is None and nactive < len(mask):
+                    keep, done = mask.nonzero().view(-1), (1 - mask).nonzero().view(-1)
+                    output_hidden = torch_utils.scatter_hidden(
+                        output_hidden, torch_utils.select_hidden(hidden, done),
+                        active[done], batch)
+                    hidden = torch_utils.select_hidden(hidden, keep)
+                    active, mask, word = active[keep], mask[keep], word[keep]
+                    bconds = bconds[:, keep]
+                    if torch.is_tensor(tau):
+                        tau = tau[keep]
+                    if end_mask is not None and end_mask.dim() == 2:
+                        end_mask = end_mask[keep]
+                    if len(keep) == 0:
+                        break
 
                 # get character-level input
-                char = []
-                for w in word.tolist():  # iterate over batch
-                    w = encoder.word.i2w[w]
-                    c = encoder.char.transform(w)
-                    char.append(c)
-                char, nchars = utils.get_batch(char, encoder.char.pad, self.device)
+                if vocab_cembs is not None:
+                    cemb = vocab_cembs.index_select(0, word).unsqueeze(0)
+                else:
+                    char = []
+                    for w in word.tolist():  # iterate over batch
+                        w = encoder.word.i2w[w]
+                        c = encoder.char.transform(w)
+                        char.append(c)
+                    char, nchars = utils.get_batch(char, encoder.char.pad, self.device)
+                    cemb = self.embed_chars(char, nchars, [1] * len(nchars))
+
+            # write back hidden state of unfinished rows
+            if len(active) > 0 and hidden[0] is not None:
+                output_hidden = torch_utils.scatter_hidden(
+                    output_hidden, hidden, active, batch)
+
+        if output_hidden is not None:
+            hidden = output_hidden
+        hidden = self.unpack_hidden(hidden)
+
+        if validate:
+            # probability of 0 for invalid lines
+            scores[~flags.is_valid(output, lengths, encoder.reverse)] = -float('inf')
 
         # transform output to list-batch of hyps
-        output = [output[i] for i in range(len(output))]
+        output = [[encoder.word.i2w[w] for w in hyp[:length]]
+                  for hyp, length in zip(output.t().tolist(), lengths.tolist())]
 
         # prepare output
-        conds = {c: encoder.conds[c].i2w[cond] for c, cond in conds.items()}
+        conds = encoder.decode_conds(conds)
         hyps, probs = [], []
         for hyp, score in zip(output, scores):
             try:
@@ -328,6 +660,163 @@ class RNNLanguageModel(nn.Module):
 
         return (hyps, conds), probs, hidden, cache
 
+    def beam_search(self, encoder, beam=5, conds=None, hidden=None, nsyms=100,
+                    nbest=None, length_penalty=1.0, min_len=1, **kwargs):
+        """
+        Beam search decoding of a single continuation. Model-specific parts are
+        implemented by `beam_setup`, `beam_step`, `beam_update` and `beam_decode`.
+
+        Arguments:
+        ----------
+        - beam : int, beam width
+        - conds : dict of condition ids (missing conditions are sampled)
+        - hidden : hidden state to start from (batch of 1) or None
+        - nsyms : int, maximum number of decoding steps
+        - nbest : int, number of hypotheses to return (defaults to `beam`)
+        - length_penalty : float, exponent of the GNMT length penalty
+            ((5 + length) / 6) ** length_penalty used to normalize the scores
+        - min_len : int, minimum number of output symbols before EOS
+
+        Returns: (hyps, conds), scores, hidden
+        --------
+        Hypotheses sorted by length-normalized log-probability (best first) and
+        the hidden state after each of them (batch of `nbest`)
+        """
+        nbest = nbest or beam
+
+        # sample conditions if needed
+        conds = dict(conds or {})
+        for c in sorted(self.conds):
+            if c not in conds:
+                conds[c] = random.choice(list(encoder.conds[c].w2i.values()))
+
+        def penalize(score, length):
+            return score / (((5 + length) / 6) ** length_penalty)
+
+        finished = []   # (normalized score, output symbols, hidden)
+
+        with torch.no_grad():
+            state = self.beam_setup(encoder, conds, hidden, **kwargs)
+            # accumulated logprob and output symbols of the running hypotheses
+            scores = torch.zeros(1).to(self.device)
+            seqs = torch.zeros(1, 0, dtype=torch.int64).to(self.device)
+
+            for _ in range(nsyms):
+                # (n x vocab)
+                logprob = self.beam_step(encoder, state)
+                vocab = logprob.size(1)
+                if seqs.size(1) < min_len:
+                    logprob[:, state['eos']] = -float('inf')
+                # twice the beam, so that there is enough left after removing EOS
+                top, index = (scores.unsqueeze(1) + logprob).view(-1).topk(
+                    min(2 * beam, logprob.numel()))
+                source, token = index // vocab, index % vocab
+
+                # move hypotheses ending in EOS to finished
+                is_eos = token.eq(state['eos'])
+                for idx in is_eos.nonzero().view(-1).tolist():
+                    finished.append((
+                        penalize(top[idx].item(), seqs.size(1)),
+                        seqs[source[idx]].tolist(),
+                        torch_utils.select_hidden(state['hidden'], source[idx:idx+1])))
+
+                keep = (1 - is_eos.long()).nonzero().view(-1)[:beam]
+                if len(finished) >= beam or len(keep) == 0:
+                    break
+
+                source, token, scores = source[keep], token[keep], top[keep]
+                seqs = torch.cat([seqs[source], token.unsqueeze(1)], 1)
+                state = self.beam_update(encoder, state, source, token)
+
+            # ran out of steps: add running hypotheses
+            if len(finished) < nbest:
+                for idx, (score, seq) in enumerate(zip(scores.tolist(), seqs.tolist())):
+                    finished.append((
+                        penalize(score, len(seq)), seq,
+                        torch_utils.select_hidden(
+                            state['hidden'], torch.tensor([idx]).to(self.device))))
+
+        finished = sorted(finished, key=lambda item: item[0], reverse=True)[:nbest]
+
+        # prepare output
+        conds = encoder.decode_conds(conds)
+        hyps, scores, hidden = [], [], []
+        for score, seq, h in finished:
+            hyp = self.beam_decode(encoder, seq)
+            hyps.append(' '.join(hyp[::-1] if encoder.reverse else hyp))
+            scores.append(score)
+            hidden.append(h)
+
+        return (hyps, conds), scores, self.unpack_hidden(torch_utils.cat_hidden(hidden))
+
+    def beam_setup(self, encoder, conds, hidden, avoid_unk=False, **kwargs):
+        """
+        Create the decoding state for `beam_search`
+        """
+        if hidden is not None:
+            h = hidden[0][0] if isinstance(hidden[0], tuple) else hidden[0]
+            if h.size(1) != 1:
+                raise ValueError("Beam search expects a hidden state of batch 1")
+
+        # (1 x 1 x cond_dim)
+        bconds = []
+        for c in sorted(self.conds):
+            bcond = torch.tensor([conds[c]], dtype=torch.int64).to(self.device)
+            bconds.append(self.conds[c](bcond).unsqueeze(0))
+
+        # (3 x 1)
+        char = [[encoder.char.bos, encoder.char.bol, encoder.char.eos]]
+        char = torch.tensor(char, dtype=torch.int64).to(self.device).t()
+
+        return {"eos": encoder.word.eos,
+                "avoid_unk": avoid_unk,
+                "hidden": self.pack_hidden(hidden or [None] * len(self.rnn)),
+                "bconds": bconds,
+                "word": torch.tensor([encoder.word.bos]).to(self.device),
+                "cemb": self.embed_chars(char, [3], [1])}
+
+    def beam_step(self, encoder, state):
+        """
+        Run one step over the running hypotheses and return (n x vocab) logprobs
+        """
+        n = len(state['word'])
+        embs = [self.wembs(state['word'].unsqueeze(0)), state['cemb']]
+        embs = torch.cat(embs + [bcond.expand(1, n, -1) for bcond in state['bconds']], -1)
+
+        # rnn
+        outs, state['hidden'] = self.run_rnn(embs, state['hidden'])
+
+        # same <unk> suppression as sampling
+        logits = torch_utils.process_logits(
+            self.proj(outs.squeeze(0)),
+            unk=encoder.word.unk if state['avoid_unk'] else None)
+
+        return F.log_softmax(logits, dim=-1)
+
+    def beam_update(self, encoder, state, source, token):
+        """
+        Reorder the state according to the selected hypotheses `source` and feed
+        the selected output symbols `token`
+        """
+        state['hidden'] = torch_utils.select_hidden(state['hidden'], source)
+        state['word'] = token
+
+        if self.vocab_cembs is not None:
+            cemb = self.vocab_cembs.to(self.device).index_select(0, token)
+            state['cemb'] = cemb.unsqueeze(0)
+        else:
+            char = [encoder.char.transform(encoder.word.i2w[w]) for w in token.tolist()]
+            char, nchars = utils.get_batch(char, encoder.char.pad, self.device)
+            state['cemb'] = self.embed_chars(char, nchars, [1] * len(nchars))
+
+        return state
+
+    def beam_decode(self, encoder, seq):
+        """
+        Transform output symbols into a list of tokens
+        """
+        return [encoder.word.i2w[w] for w in seq]
+
     def dev(self, corpus, encoder, best_loss, fails, nsamples=10):
         self.eval()
 
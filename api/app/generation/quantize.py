@@ -0,0 +1,82 @@
+
+import io
+import time
+
+import torch
+import tqdm
+
+
+def evaluate(model, encoder, corpus):
+    """
+    Dev loss of the model over the corpus (in the unit of `model.loss_formatter`)
+    """
+    hidden = None
+    tloss = tinsts = 0
+
+    with torch.no_grad():
+        for sents, conds in tqdm.tqdm(corpus.get_batches(1)):
+            (words, nwords), (chars, nchars), conds = encoder.transform_batch(
+                sents, conds, model.device)
+            logits, hidden = model(words, nwords, chars, nchars, conds, hidden)
+            loss, insts = model.loss(logits, words, nwords, chars, nchars)
+            tinsts += insts
+            tloss += loss.item()
+
+    return model.loss_formatter(tloss / tinsts)
+
+
+def throughput(model, encoder, nsamples=20, batch=10, **kwargs):
+    """
+    Sampling throughput as (lines per second, words per second)
+    """
+    nlines = nwords = 0
+    start = time.time()
+    for _ in range(nsamples):
+        (hyps, _), _, _, _ = model.sample(encoder, batch=batch, **kwargs)
+        nlines += len(hyps)
+        nwords += sum(len(hyp.split()) for hyp in hyps)
+    elapsed = time.time() - start
+
+    return nlines / elapsed, nwords / elapsed
+
+
+def model_size(model):
+    """
+    Size in MB of the serialized weights
+    """
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 1e6
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compare dynamic int8 quantization against fp32")
+    parser.add_argument('--model')
+    parser.add_argument('--dev')
+    parser.add_argument('--dpath', default='./data/ohhla.vocab.phon.json')
+    parser.add_argument('--nsamples', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1001)
+    args = parser.parse_args()
+
+    from generation import utils, model_loader
+
+    results = {}
+    for quantize in (False, True):
+        model, encoder = model_loader(args.model, quantize=quantize)
+        dev = utils.CorpusReader(args.dev, dpath=args.dpath or None)
+        torch.manual_seed(args.seed)
+        results[quantize] = (evaluate(model, encoder, dev), model_size(model),
+                             *throughput(model, encoder, args.nsamples, args.batch))
+
+    print("{:<6} {:>10} {:>10} {:>10} {:>10}".format(
+        "", "dev loss", "size (MB)", "lines/s", "words/s"))
+    for quantize, name in [(False, 'fp32'), (True, 'int8')]:
+        print("{:<6} {:>10.4f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, *results[quantize]))
+    (floss, fsize, flps, _), (qloss, qsize, qlps, _) = results[False], results[True]
+    print()
+    print("dev loss delta: {:+.4f} ({:+.2%})".format(qloss - floss, (qloss - floss) / floss))
+    print("size ratio: {:.2f}, speedup: {:.2f}x".format(qsize / fsize, qlps / flps))
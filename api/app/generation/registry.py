@@ -0,0 +1,45 @@
+
+import os
+import threading
+import collections.abc
+
+from . import model_loader
+
+
+class ModelRegistry(collections.abc.Mapping):
+    """
+    Mapping from model names (weights files in `dirpath` without extension) to
+    models, which are only loaded on first access with `load(modelpath)` (by
+    default `model_loader` with memory-mapped weights). Instantiation only
+    lists the directory, so that processes start fast and only pay for the
+    models they actually use.
+    """
+    def __init__(self, dirpath, load=None):
+        self.dirpath = dirpath
+        self.load = load or (lambda modelpath: model_loader(modelpath, mmap=True))
+        self.names = sorted(fname[:-len('.pt')] for fname in os.listdir(dirpath)
+                            if fname.endswith('.pt'))
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            if name not in self.names:
+                raise KeyError(name)
+            with self.lock:
+                if name not in self.cache:
+                    self.cache[name] = self.load(os.path.join(self.dirpath, name))
+
+        return self.cache[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def loaded(self):
+        """
+        Already loaded models (doesn't trigger any loading)
+        """
+        return dict(self.cache)
@@ -9,8 +9,8 @@ from . import utils
 random.seed(1001)
 
 
-def sample_rhymes(model, encoder, rhyme,
-                  ntries=100, nsamples=1000, length=15, tau=0.85, tau_std=0.075):
+def sample_rhymes(model, encoder, rhyme, ntries=100, nsamples=1000, length=15,
+                  tau=0.85, tau_std=0.075, rhyme_masks=None):
     conds = {}
     if 'length' in encoder.conds:
         conds['length'] = encoder.conds['length'].w2i[length]
@@ -22,7 +22,8 @@ def sample_rhymes(model, encoder, rhyme,
     while run and ntries_ > 0:
         try:
             (samples, _), _, _, _ = model.sample(
-                encoder, tau=random.gauss(tau, tau_std), conds=conds, batch=100)
+                encoder, tau=random.gauss(tau, tau_std), conds=conds, batch=100,
+                rhyme_masks=rhyme_masks)
 
             for sample in samples:
                 if tsamples >= nsamples:
@@ -65,6 +66,10 @@ if __name__ == '__main__':
     parser.add_argument('--tau_std', default=0.075, type=float)
     parser.add_argument('--device', default='cpu')
     parser.add_argument('--debug', action='store_true', help="Print sampled examples")
+    parser.add_argument('--dpath', help='/path/to/phonological dict to constrain '
+                        'line endings to the rhyme')
+    parser.add_argument('--songs', help='/path/to/songs (jsonl) to find the rhymes '
+                        'of word-final syllables (requires --dpath)')
     args = parser.parse_args()
 
     from generation import model_loader
@@ -72,6 +77,15 @@ if __name__ == '__main__':
     model, encoder = model_loader(args.model)
     model.to(args.device)
 
+    rhyme_masks = None
+    if args.dpath:
+        with open(args.dpath) as f:
+            d = json.loads(f.read())
+        lines = ()
+        if args.songs:
+            lines = (line for line, _ in utils.lines_from_jsonl(args.songs))
+        rhyme_masks = utils.get_rhyme_masks(encoder, d, lines=lines)
+
     path = '{}.rhymes.csv'.format(model.modelname)
 
     missing = {k: args.nsamples for k in encoder.conds['rhyme'].w2i.keys()}
@@ -86,5 +100,5 @@ if __name__ == '__main__':
             for rhyme, sample in sample_rhymes(
                     model, encoder, rhyme,
                     nsamples=args.nsamples, length=args.length,
-                    tau=args.tau, tau_std=args.tau_std):
+                    tau=args.tau, tau_std=args.tau_std, rhyme_masks=rhyme_masks):
                 f.write('\t'.join([rhyme, sample]) + '\n')
@@ -0,0 +1,117 @@
+
+import os
+import json
+import random
+
+from . import utils
+
+
+class TemplateStore:
+    """
+    Precompiled (rhyme, length) condition templates of all verses in a songs file,
+    so that templates can be sampled without the phonological dictionary. The
+    store is a set of files sharing the prefix `path` (see `compile`):
+
+        - path.json : header with the rhyme vocabulary and the record counts
+        - path.verses : (nverses) records (nlines, start line, metadata offset,
+            verse index), sorted by number of lines
+        - path.lines : (nlines) records (rhyme id, length bucket)
+        - path.meta : song metadata (jsonl)
+
+    Verse and line records are memory-mapped. Has the same `sample` interface as
+    `TemplateSampler`.
+    """
+    VERSE = [('nlines', '<i4'), ('start', '<i8'), ('meta', '<i8'), ('verse', '<i4')]
+    LINE = [('rhyme', '<i4'), ('length', '<i2')]
+
+    def __init__(self, path):
+        import numpy as np
+
+        self.path = path
+        with open(path + '.json') as f:
+            self.rhymes = json.loads(f.read())['rhymes']
+        self.verses = np.memmap(path + '.verses', mode='r', dtype=self.VERSE)
+        self.lines = np.memmap(path + '.lines', mode='r', dtype=self.LINE)
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.isfile(path + ext) for ext in ('.json', '.verses', '.lines', '.meta'))
+
+    @classmethod
+    def compile(cls, fpath, dpath, path):
+        """
+        Compute the templates of all verses in the songs file `fpath` with the
+        phonological dictionary in `dpath` (as `TemplateSampler` does) and store
+        them with prefix `path`
+        """
+        import numpy as np
+
+        with open(dpath) as f:
+            d = json.loads(f.read())
+
+        rhymes, verses, lines = {}, [], []
+        with open(fpath, 'rb') as f, open(path + '.meta', 'wb') as meta:
+            for line in f:
+                try:
+                    song = json.loads(line)
+                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                    continue  # corrupted line
+                offset = meta.tell()
+                metadata = {key: song[key] for key in ('id', 'album', 'artist', 'song')}
+                meta.write((json.dumps(metadata) + '\n').encode())
+                for verse, vlines in enumerate(song['text']):
+                    verses.append((len(vlines), len(lines), offset, verse))
+                    for vline in vlines:
+                        _, conds = utils.prepare_line(vline, d=d)
+                        rhyme = rhymes.setdefault(conds['rhyme'], len(rhymes))
+                        lines.append((rhyme, conds['length']))
+
+        # bucket by number of lines
+        verses = np.array(verses, dtype=cls.VERSE)
+        verses = verses[np.argsort(verses['nlines'], kind='stable')]
+        verses.tofile(path + '.verses')
+        np.array(lines, dtype=cls.LINE).tofile(path + '.lines')
+        with open(path + '.json', 'w') as f:
+            json.dump({'rhymes': sorted(rhymes, key=rhymes.get),
+                       'nverses': len(verses), 'nlines': len(lines)}, f)
+
+        return cls(path)
+
+    def sample(self, nlines=None):
+        """
+        Sample uniformly from all verses with at least `nlines` lines
+
+        Returns: template, metadata (see `TemplateSampler.sample`)
+        """
+        import numpy as np
+
+        start = np.searchsorted(self.verses['nlines'], nlines or 0, side='left')
+        if start >= len(self.verses):
+            raise RuntimeError("Couldn't find template of #{} lines".format(nlines))
+        verse = self.verses[random.randrange(start, len(self.verses))]
+
+        lines = self.lines[verse['start']: verse['start'] + verse['nlines']]
+        template = [{'rhyme': self.rhymes[rhyme], 'length': int(length)}
+                    for rhyme, length in lines.tolist()]
+
+        with open(self.path + '.meta', 'rb') as f:
+            f.seek(int(verse['meta']))
+            metadata = json.loads(f.readline())
+        metadata['verse'] = int(verse['verse'])
+
+        return template, metadata
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compile the templates of a songs file into a `TemplateStore`")
+    parser.add_argument('--songs', required=True, help='/path/to/songs (jsonl)')
+    parser.add_argument('--dpath', required=True, help='/path/to/phonological dict')
+    parser.add_argument('--output', help='/path/prefix of the store (defaults to songs)')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.songs)[0] + '.templates'
+    store = TemplateStore.compile(args.songs, args.dpath, output)
+    print("Compiled #{} verses ({} lines, {} rhymes) into {}".format(
+        len(store.verses), len(store.lines), len(store.rhymes), output))
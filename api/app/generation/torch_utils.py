@@ -130,6 +130,111 @@ def update_hidden(old_hidden, new_hidden, mask):
     return new_hidden
 
 
+def select_hidden(hidden, index):
+    """
+    Select the batch entries given by `index` from a list of hidden states
+
+    hidden: list of (layers x batch x dim) tensors or tuples of those
+    index: LongTensor(n)
+    """
+    output = []
+    for h in hidden:
+        if isinstance(h, tuple):
+            output.append(tuple(h_.index_select(1, index) for h_ in h))
+        else:
+            output.append(h.index_select(1, index))
+
+    return output
+
+
+def scatter_hidden(target, hidden, index, batch):
+    """
+    Copy (in place) the batch entries of `hidden` into the positions `index` of
+    `target`. If `target` is None, a zero hidden state with `batch` entries is
+    created first.
+
+    target: list of (layers x batch x dim) tensors or tuples of those, or None
+    hidden: list of (layers x n x dim) tensors or tuples of those
+    index: LongTensor(n)
+    """
+    def zeros(h):
+        return h.new_zeros(h.size(0), batch, h.size(2))
+
+    if target is None:
+        target = []
+        for h in hidden:
+            if isinstance(h, tuple):
+                target.append(tuple(zeros(h_) for h_ in h))
+            else:
+                target.append(zeros(h))
+
+    for t, h in zip(target, hidden):
+        if isinstance(h, tuple):
+            for t_, h_ in zip(t, h):
+                t_.index_copy_(1, index, h_)
+        else:
+            t.index_copy_(1, index, h)
+
+    return target
+
+
+def cat_hidden(hiddens):
+    """
+    Concatenate a list of hidden states along the batch dimension
+    """
+    output = []
+    for hs in zip(*hiddens):
+        if isinstance(hs[0], tuple):
+            output.append(tuple(torch.cat(h_, 1) for h_ in zip(*hs)))
+        else:
+            output.append(torch.cat(hs, 1))
+
+    return output
+
+
+def stack_hidden(hidden):
+    """
+    Stack a list of per-layer hidden states into the single-entry list used by
+    a multi-layer rnn
+
+    hidden: list of (1 x batch x dim) tensors or tuples of those (or Nones)
+    """
+    if hidden[0] is None:
+        return [None]
+    if isinstance(hidden[0], tuple):
+        return [tuple(torch.cat(h, 0) for h in zip(*hidden))]
+    return [torch.cat(hidden, 0)]
+
+
+def split_hidden(hidden, layers):
+    """
+    Inverse of `stack_hidden`
+
+    hidden: single-entry list of (layers x batch x dim) tensors or tuples of those
+    """
+    if hidden[0] is None:
+        return [None] * layers
+    if isinstance(hidden[0], tuple):
+        return list(zip(*(h.split(1, 0) for h in hidden[0])))
+    return list(hidden[0].split(1, 0))
+
+
+def batch_values(value, batch, dtype=torch.int64):
+    """
+    (batch) tensor from a single value (shared by all rows) or a per-row list
+
+    >>> batch_values(3, 2).tolist()
+    [3, 3]
+    >>> batch_values([1.0, 0.5], 2, dtype=torch.float).tolist()
+    [1.0, 0.5]
+    """
+    if not isinstance(value, (list, tuple)):
+        value = [value] * batch
+    if len(value) != batch:
+        raise ValueError("Expected {} values but got {}".format(batch, len(value)))
+    return torch.tensor(value, dtype=dtype)
+
+
 def sequential_dropout(inp, p, training):
     if not training or not p:
         return inp
@@ -162,15 +267,136 @@ def embedded_dropout(embed, words, dropout=0.1, scale=None):
                                          embed.scale_grad_by_freq, embed.sparse)
 
 
-def batch_index_add(t, index, src):
+def process_logits(logits, tau=1.0, top_k=0, top_p=1.0, unk=None,
+                   prev=None, repetition_penalty=1.0, allowed=None):
+    """
+    Transform (batch x vocab) logits into the logits of the sampling distribution.
+    The steps are applied in order on a copy of the input (the input is left
+    untouched): temperature, repetition penalty, <unk> suppression, masking of
+    the entries that aren't allowed and top-k/nucleus (top-p) truncation (which
+    share a single sort).
+
+    Parameters:
+    -----------
+    logits: torch.Tensor(batch x vocab), logits or logprobs
+    tau: float or torch.Tensor(batch), temperature (per row)
+    top_k: int, keep only the `top_k` most likely entries (0 to disable)
+    top_p: float, keep only the smallest set of most likely entries with
+        cumulative probability above `top_p` (1.0 to disable)
+    unk: int or None, index of the entry to suppress
+    prev: LongTensor(batch x n) or None, previously generated entries
+    repetition_penalty: float, penalty for entries in `prev` (1.0 to disable)
+    allowed: BoolTensor(vocab) or BoolTensor(batch x vocab) or None, entries
+        that can be sampled (applied before truncation)
+
+    >>> logits = torch.tensor([[1.0, 4.0, 3.0, 2.0]])
+    >>> process_logits(logits, top_k=2).exp().tolist()
+    [[0.0, 54.598148345947266, 20.08553695678711, 0.0]]
+    >>> process_logits(logits, unk=1, top_p=0.5).exp().tolist()
+    [[0.0, 0.0, 20.08553695678711, 0.0]]
+    >>> allowed = torch.tensor([True, False, False, True])
+    >>> process_logits(logits, top_k=1, allowed=allowed).exp().tolist()
+    [[0.0, 0.0, 0.0, 7.389056205749512]]
+    >>> process_logits(torch.ones(2, 2), tau=torch.tensor([1.0, 0.5])).tolist()
+    [[1.0, 1.0], [2.0, 2.0]]
+    """
+    logits = logits / (tau.unsqueeze(1) if torch.is_tensor(tau) else tau)
+
+    if prev is not None and prev.numel() > 0 and repetition_penalty != 1.0:
+        penalized = logits.gather(1, prev)
+        penalized = torch.where(penalized > 0,
+                                penalized / repetition_penalty,
+                                penalized * repetition_penalty)
+        logits.scatter_(1, prev, penalized)
+
+    if unk is not None:
+        logits[:, unk] = -float('inf')
+
+    if allowed is not None:
+        logits.masked_fill_(~allowed, -float('inf'))
+
+    if top_k > 0 or top_p < 1.0:
+        # single sort for both truncation methods
+        sorted_logits, index = logits.sort(dim=1, descending=True)
+        if top_k > 0:
+            sorted_logits[:, top_k:] = -float('inf')
+        if top_p < 1.0:
+            probs = torch.nn.functional.softmax(sorted_logits, dim=1)
+            # remove entries once the previous ones already cover `top_p`
+            # (always keeps the most likely entry)
+            remove = (probs.cumsum(1) - probs) > top_p
+            sorted_logits.masked_fill_(remove, -float('inf'))
+        logits.scatter_(1, index, sorted_logits)
+
+    return logits
+
+
+def batch_index_add(t, index, src, out=None):
     """
-    Add values in `src` indexed by `index`
+    Add values in `src` indexed by `index` (along the vocab dimension)
 
     t: (batch x vocab)
     index: (batch x cache_size)
     src: (batch x cache_size)
+    out: (batch x vocab), optional output buffer. Pass `t` itself to add in place
+        or a preallocated buffer to reuse it across calls.
+
+    >>> t = torch.zeros(2, 3)
+    >>> index = torch.tensor([[0, 0], [2, 1]])
+    >>> src = torch.tensor([[1.0, 2.0], [3.0, 4.0]])
+    >>> batch_index_add(t, index, src).tolist()
+    [[3.0, 0.0, 0.0], [0.0, 4.0, 3.0]]
+    >>> _ = batch_index_add(t, index, src, out=t)
+    >>> t.tolist()
+    [[3.0, 0.0, 0.0], [0.0, 4.0, 3.0]]
     """
-    batch, vocab = t.size()
-    ex = torch.arange(0, batch, out=t.new()).unsqueeze(1).long() * vocab
-    added = t.view(-1).index_add(0, (index + ex).view(-1), src.view(-1))
-    return added.view(batch, vocab)
+    if out is None:
+        out = t.clone()
+    elif out is not t:
+        out.copy_(t)
+
+    return out.scatter_add_(1, index, src)
+
+
+if __name__ == '__main__':
+    # microbenchmark batch_index_add against the flat index_add implementation
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--cache_size', type=int, default=200)
+    parser.add_argument('--vocabs', default='10000,15000,20000,25000')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    def flat_batch_index_add(t, index, src):
+        batch, vocab = t.size()
+        ex = torch.arange(0, batch, out=t.new()).unsqueeze(1).long() * vocab
+        added = t.view(-1).index_add(0, (index + ex).view(-1), src.reshape(-1))
+        return added.view(batch, vocab)
+
+    def timeit(fn):
+        start = time.time()
+        for _ in range(args.iterations):
+            fn()
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        return (time.time() - start) / args.iterations * 1000
+
+    for vocab in map(int, args.vocabs.split(',')):
+        t = torch.rand(args.batch, vocab).to(args.device)
+        index = torch.randint(0, vocab, (args.batch, args.cache_size)).to(args.device)
+        src = torch.rand(args.batch, args.cache_size).to(args.device)
+        buf = torch.zeros_like(t)
+
+        assert torch.allclose(flat_batch_index_add(t, index, src),
+                              batch_index_add(t, index, src, out=buf))
+
+        print("vocab={:<6} flat={:.3f}ms scatter={:.3f}ms scatter+out={:.3f}ms "
+              "scatter+inplace={:.3f}ms".format(
+                  vocab,
+                  timeit(lambda: flat_batch_index_add(t, index, src)),
+                  timeit(lambda: batch_index_add(t, index, src)),
+                  timeit(lambda: batch_index_add(t, index, src, out=buf)),
+                  timeit(lambda: batch_index_add(t, index, src, out=t))))
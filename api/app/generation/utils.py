@@ -1,5 +1,6 @@
 
 import re
+import os
 import json
 import collections
 import torch
@@ -204,7 +205,8 @@ class Vocab:
 
         for sym, _ in counter.most_common(int(most_common)):
             self.w2i.setdefault(sym, len(self.w2i))
-        self.i2w = {i: w for w, i in self.w2i.items()}
+        # array-backed inverse mapping (indices are contiguous)
+        self.i2w = sorted(self.w2i, key=self.w2i.get)
 
     def size(self):
         return len(self.w2i.keys())
@@ -237,9 +239,21 @@ class Vocab:
     def from_dict(cls, d):
         inst = cls(collections.Counter())
         inst.w2i = {d["key"]: d["val"] for d in d['w2i']}
+        inst.reserved = dict(d['reserved'])
         for key, val in d['reserved'].items():
             setattr(inst, key, inst.w2i[val])
-        inst.i2w = {val: key for key, val in inst.w2i.items()}
+        inst.i2w = sorted(inst.w2i, key=inst.w2i.get)
+
+        return inst
+
+    @classmethod
+    def from_list(cls, i2w, reserved):
+        inst = cls(collections.Counter())
+        inst.i2w = i2w
+        inst.w2i = {w: i for i, w in enumerate(i2w)}
+        inst.reserved = dict(reserved)
+        for key, val in reserved.items():
+            setattr(inst, key, inst.w2i[val])
 
         return inst
 
@@ -256,12 +270,144 @@ def get_batch(sents, pad, device):
     return t, lengths
 
 
+class CharTrie:
+    """
+    Trie over the character ids of the word vocabulary, stored as a sorted
+    array of (parent * nchars + char) edge keys, so that whole batches of
+    generated character sequences can be mapped to word ids with one
+    `searchsorted` per character position. Sequences that don't spell an
+    entry of the vocabulary map to `word.unk`.
+    """
+    def __init__(self, word, char):
+        self.nchars = char.size()
+        self.unk = word.unk
+        edges, terminal = {}, {0: self.unk}
+        for w, idx in sorted(word.w2i.items(), key=lambda it: it[1]):
+            node = 0
+            for c in w:
+                key = node * self.nchars + char.transform_item(c)
+                if key not in edges:
+                    edges[key] = len(edges) + 1
+                node = edges[key]
+            terminal.setdefault(node, idx)
+
+        keys = sorted(edges)
+        self.keys = torch.tensor(keys, dtype=torch.int64)
+        self.children = torch.tensor([edges[k] for k in keys], dtype=torch.int64)
+        self.words = torch.tensor(
+            [terminal.get(node, self.unk) for node in range(len(edges) + 1)],
+            dtype=torch.int64)
+
+    def to(self, device):
+        self.keys = self.keys.to(device)
+        self.children = self.children.to(device)
+        self.words = self.words.to(device)
+        return self
+
+    def lookup(self, chars, lengths):
+        """
+        chars : (seq_len x batch) char ids, lengths : (batch) number of valid ids
+
+        Returns a (batch) tensor of word ids
+        """
+        node = torch.zeros_like(lengths)
+        for step in range(chars.size(0)):
+            key = node * self.nchars + chars[step]
+            pos = torch.searchsorted(self.keys, key).clamp_(max=len(self.keys) - 1)
+            # dead nodes (-1) produce negative keys and never match again
+            child = torch.where(self.keys[pos] == key, self.children[pos],
+                                torch.full_like(node, -1))
+            node = torch.where(lengths > step, child, node)
+
+        return torch.where(node >= 0, self.words[node.clamp(min=0)],
+                           torch.full_like(node, self.unk))
+
+
+class TokenFlags:
+    """
+    Per-token boolean flags of a vocabulary, so that the checks of `is_valid`
+    can be run over batches of sampled token ids and used as a decoding-time
+    mask that prevents broken syllable continuations:
+
+        - start : token continues a word ("-syl")
+        - end : token is continued by the next one ("syl-")
+        - unk : token is <unk>
+    """
+    def __init__(self, vocab):
+        self.start = torch.tensor([w.startswith('-') for w in vocab.i2w], dtype=torch.bool)
+        self.end = torch.tensor([w.endswith('-') for w in vocab.i2w], dtype=torch.bool)
+        self.unk = torch.zeros(len(vocab.i2w), dtype=torch.bool)
+        if getattr(vocab, 'unk', None) is not None:
+            self.unk[vocab.unk] = True
+
+    def to(self, device):
+        self.start = self.start.to(device)
+        self.end = self.end.to(device)
+        self.unk = self.unk.to(device)
+        return self
+
+    def is_valid(self, output, lengths, reverse=False):
+        """
+        Vectorized `is_valid` over sampled lines
+
+        output : (seq_len x batch) token ids in generation order (lines are
+            reversed if `reverse`), lengths : (batch) number of valid ids
+
+        Returns a (batch) bool tensor
+        """
+        positions = torch.arange(output.size(0), device=output.device).unsqueeze(1)
+        # (seq_len x batch)
+        valid = positions < lengths
+        start, end = self.start[output], self.end[output]
+        last = (lengths - 1).clamp(min=0).unsqueeze(0)
+        if reverse:
+            first, final = start.gather(0, last).squeeze(0), end[0]
+            # token i + 1 precedes token i in the line
+            broken = end[1:] & ~start[:-1]
+        else:
+            first, final = start[0], end.gather(0, last).squeeze(0)
+            broken = end[:-1] & ~start[1:]
+        broken = (broken & valid[1:]).any(0)
+        unk = (self.unk[output] & valid).any(0)
+
+        return (lengths > 0) & ~unk & ~first & ~final & ~broken
+
+    def get_mask(self, word, first, reverse=False, eos=None):
+        """
+        (batch x vocab) tokens that keep the line valid after the previously
+        sampled tokens `word` (batch), where `first` indicates that nothing has
+        been sampled yet. Tokens are sampled right to left if `reverse`. If
+        given, `eos` is only allowed where the line would be valid (and never
+        for empty lines).
+        """
+        if first:
+            # the first (last if reverse) token can't be a continuation
+            allowed = ~(self.end if reverse else self.start)
+            allowed = allowed.unsqueeze(0).repeat(len(word), 1)
+            if eos is not None:
+                allowed[:, eos] = False
+        elif reverse:
+            # tokens ending in '-' can only precede a continuation
+            allowed = ~(self.end.unsqueeze(0) & ~self.start[word].unsqueeze(1))
+            if eos is not None:
+                allowed[:, eos] = ~self.start[word]
+        else:
+            # tokens ending in '-' can only be followed by a continuation
+            allowed = ~(self.end[word].unsqueeze(1) & ~self.start.unsqueeze(0))
+            if eos is not None:
+                allowed[:, eos] = ~self.end[word]
+
+        return allowed
+
+
 class CorpusEncoder:
     def __init__(self, word, char, conds, reverse=False):
         self.word = word
         self.char = char
         self.conds = conds
         self.reverse = reverse
+        # syllabification flags of the word vocabulary (see `TokenFlags`)
+        self.flags = TokenFlags(word)
 
     @classmethod
     def from_corpus(cls, *corpora, most_common=25000, **kwargs):
@@ -301,6 +447,72 @@ class CorpusEncoder:
 
         return cls(word, char, conds, obj['reverse'])
 
+    def to_binary(self, fpath):
+        """
+        Compact binary format: a json header line with the reserved symbols and
+        byte sizes of each vocabulary followed by their symbols (sorted by index)
+        as newline-separated utf-8 (or a json list for non-string symbols, e.g.
+        some conditions). Written atomically (loading processes might be reading
+        the file concurrently).
+        """
+        vocabs = [('word', self.word), ('char', self.char)]
+        vocabs += [('cond:' + c, vocab) for c, vocab in sorted(self.conds.items())]
+
+        header, blobs = {'reverse': self.reverse, 'vocabs': []}, []
+        for name, vocab in vocabs:
+            if all(isinstance(w, str) and '\n' not in w for w in vocab.i2w):
+                fmt, blob = 'lines', '\n'.join(vocab.i2w).encode()
+            else:
+                fmt, blob = 'json', json.dumps(vocab.i2w).encode()
+            header['vocabs'].append({'name': name, 'reserved': vocab.reserved,
+                                     'format': fmt, 'size': len(vocab.i2w),
+                                     'nbytes': len(blob)})
+            blobs.append(blob)
+
+        tmppath = '{}.{}.tmp'.format(fpath, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write((json.dumps(header) + '\n').encode())
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmppath, fpath)
+
+    @classmethod
+    def from_binary(cls, fpath):
+        with open(fpath, 'rb') as f:
+            header = json.loads(f.readline())
+            vocabs = {}
+            for vocab in header['vocabs']:
+                blob = f.read(vocab['nbytes']).decode()
+                if vocab['format'] == 'json':
+                    i2w = json.loads(blob)
+                else:
+                    i2w = blob.split('\n') if vocab['size'] else []
+                vocabs[vocab['name']] = Vocab.from_list(i2w, vocab['reserved'])
+
+        conds = {name[len('cond:'):]: vocab for name, vocab in vocabs.items()
+                 if name.startswith('cond:')}
+
+        return cls(vocabs['word'], vocabs['char'], conds, header['reverse'])
+
+    @classmethod
+    def load(cls, prefix):
+        """
+        Load the encoder stored at `prefix.encoder.json`, using its binary version
+        (`prefix.encoder.bin`, see `to_binary`) which is written on first load
+        """
+        jsonpath, binpath = prefix + '.encoder.json', prefix + '.encoder.bin'
+        if os.path.isfile(binpath) and (not os.path.isfile(jsonpath) or
+                                        os.path.getmtime(binpath) >= os.path.getmtime(jsonpath)):
+            return cls.from_binary(binpath)
+
+        encoder = cls.from_json(jsonpath)
+        try:
+            encoder.to_binary(binpath)
+        except OSError as e:
+            print("Couldn't store binary encoder: {}".format(e))
+
+        return encoder
+
     def transform_batch(self, sents, conds, device='cpu'):  # conds is a list of dicts
         if self.reverse:
             sents = [s[::-1] for s in sents]
@@ -327,6 +539,18 @@ class CorpusEncoder:
 
         return (words, nwords), (chars, nchars), bconds
 
+    def decode_conds(self, conds):
+        """
+        Map condition ids (single or per-row lists of ids) back to their values
+        """
+        decoded = {}
+        for c, cond in conds.items():
+            if isinstance(cond, (list, tuple)):
+                decoded[c] = [self.conds[c].i2w[i] for i in cond]
+            else:
+                decoded[c] = self.conds[c].i2w[cond]
+        return decoded
+
 
 def prepare_line(line, prev=None, d=None, include_conds=None):
     # prepare line
@@ -530,6 +754,61 @@ def get_final_phonology(phon):
     return rhyme[::-1]
 
 
+def get_rhyme_masks(encoder, d, lines=()):
+    """
+    Compute a (rhymes x vocab) BoolTensor with the words that can end a line
+    with each rhyme class in `encoder.conds['rhyme']`, labelling rhymes as in
+    `prepare_line`. Words are looked up in the phonological dictionary `d`;
+    word-final syllables (e.g. "-ing") aren't in `d`, but they are registered
+    from the last token of each line in `lines` (lines in the song jsonl format)
+    if given. The unknown rhyme class and rhyme classes without any word allow
+    all words.
+
+    >>> import collections, types
+    >>> word = Vocab(collections.Counter(['the', 'cat', 'in', 'be-', '-gin']), unk=UNK)
+    >>> rhyme = Vocab(collections.Counter(['AE1', 'IH1']), unk=UNK)
+    >>> encoder = types.SimpleNamespace(word=word, conds={'rhyme': rhyme})
+    >>> d = {'cat': 'K AE1 T', 'in': 'IH1 N', 'begin': 'B IH0 G IH1 N'}
+    >>> unknown = [{'token': 'cat', 'syllables': ['cat']},
+    ...            {'token': 'the', 'syllables': ['the']}]
+    >>> multi = [{'token': 'the', 'syllables': ['the']},
+    ...          {'token': 'begin', 'syllables': ['be', 'gin']}]
+    >>> masks = get_rhyme_masks(encoder, d, lines=[unknown, multi])
+    >>> masks[rhyme.unk].all().item()
+    True
+    >>> [word.i2w[i] for i in masks[rhyme['AE1']].nonzero().view(-1).tolist()]
+    ['cat']
+
+    Word-final syllables can only end a line if they are found in `lines`
+
+    >>> [word.i2w[i] for i in masks[rhyme['IH1']].nonzero().view(-1).tolist()]
+    ['in', '-gin']
+    >>> masks = get_rhyme_masks(encoder, d)
+    >>> [word.i2w[i] for i in masks[rhyme['IH1']].nonzero().view(-1).tolist()]
+    ['in']
+    """
+    rhymes, vocab = encoder.conds['rhyme'], encoder.word
+    masks = torch.zeros(rhymes.size(), vocab.size(), dtype=torch.bool)
+
+    for w, idx in vocab.w2i.items():
+        if w not in d:
+            continue
+        rhyme = get_final_phonology(d[w])
+        if len(rhyme) <= 2 and '-'.join(rhyme) in rhymes.w2i:
+            masks[rhymes.w2i['-'.join(rhyme)], idx] = True
+
+    for line in lines:
+        sent, conds = prepare_line(line, d=d, include_conds=('rhyme',))
+        if sent and conds['rhyme'] in rhymes.w2i and sent[-1] in vocab.w2i:
+            masks[rhymes.w2i[conds['rhyme']], vocab.w2i[sent[-1]]] = True
+
+    if UNK in rhymes.w2i:
+        masks[rhymes.w2i[UNK]] = True
+    masks[~masks.any(1)] = True
+
+    return masks
+
+
 def get_rhyme2(line1, line2, d, return_lines=False):
     """
     This only works with the extra dictionary created by running "add_phon_dict.py"
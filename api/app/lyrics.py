@@ -3,66 +3,96 @@ import json
 import os
 import uuid
 import random
+import functools
+import tempfile
+import threading
+import collections
+import concurrent.futures
 
+import torch
 from allennlp.predictors import Predictor
 
 from .generation import RNNLanguageModel, HybridLanguageModel, CharLanguageModel
-from .generation import model_loader
-from .generation import TemplateSampler, sample_conditions
+from .generation import model_loader, ModelRegistry
+from .generation import TemplateSampler, TemplateStore, sample_conditions
 # from .generation import Cache
 from .generation import utils
 
+# session used when none is given
+DEFAULT_SESSION = 'default'
 
-def load_models(config):
+
+@functools.lru_cache()
+def load_phon_dict(path):
+    with open(path) as f:
+        return json.loads(f.read())
+
+
+def load_model(config, modelpath):
     """
-    Load the models into a dictionary. Only called at loading time.
+    Load a model from MODEL_DIR with its model-specific configuration
     """
-    models = {}
-    for modelname in os.listdir(config['MODEL_DIR']):
-        if not modelname.endswith('.pt'):  # avoid non-weight files if present
-            continue
-
-        modelname = '.'.join(modelname.split('.')[:-1])  # remove extension
-
-        if modelname in models:  # already loaded
-            continue
-
-        mconfig = {"path": modelname}
-        if config['MODELS']:
-            if modelname in config['MODELS']:
-                mconfig = config['MODELS'][modelname]
-
-        # load model
-        print("Loading model: {}".format(modelname))
-        model, encoder = model_loader(os.path.join(config['MODEL_DIR'], modelname))
-
-        # load rhyme weights
-        rweights = {}
-        rpath = os.path.join(config['MODEL_DIR'], modelname + '.rhyme.stats.json')
-        if os.path.isfile(rpath):
-            with open(rpath) as f:
-                rweights = {r: w['entropy'] for r, w in json.loads(f.read()).items()}
-
-        # create cache if necessary
-        cache = None
-        # if mconfig.get("options", {}).get("cache"):
-        #     cache = Cache.new(
-        #         model.hidden_dim,                  # hidden_dim
-        #         config['MODEL_DEFAULTS']["cache_size"])  # cache_size
-
-        # add mconfig
-        models[modelname] = {
-            "model": model,
+    modelname = os.path.basename(modelpath)
+    mconfig = {"path": modelname}
+    if config['MODELS']:
+        if modelname in config['MODELS']:
+            mconfig = config['MODELS'][modelname]
+
+    # load model (weights are memory-mapped and shared among workers)
+    print("Loading model: {}".format(modelname))
+    model, encoder = model_loader(
+        modelpath, mmap=True,
+        quantize=mconfig.get("options", {}).get("quantize", False))
+
+    # load rhyme weights
+    rweights = {}
+    rpath = modelpath + '.rhyme.stats.json'
+    if os.path.isfile(rpath):
+        with open(rpath) as f:
+            rweights = {r: w['entropy'] for r, w in json.loads(f.read()).items()}
+
+    # words that can end a line with each rhyme (word-level models only)
+    rhyme_masks = None
+    if mconfig.get("options", {}).get("rhyme_mask") and os.path.isfile(config['PHON_DICT']) \
+       and type(model) is RNNLanguageModel and 'rhyme' in encoder.conds:
+        # register word-final syllables from the songs (if available)
+        lines = ()
+        if os.path.isfile(config['SONG_PATH']):
+            lines = (line for line, _ in utils.lines_from_jsonl(config['SONG_PATH']))
+        rhyme_masks = utils.get_rhyme_masks(
+            encoder, load_phon_dict(config['PHON_DICT']), lines=lines)
+
+    # char-level models have no beam search: fall back to sampling
+    options = dict(mconfig.get("options", {}))
+    if options.get("beam") and type(model) is CharLanguageModel:
+        print("Beam search isn't available for {}, sampling instead".format(modelname))
+        del options["beam"]
+
+    # create cache if necessary
+    cache = None
+    # if mconfig.get("options", {}).get("cache"):
+    #     cache = Cache.new(
+    #         model.hidden_dim,                  # hidden_dim
+    #         config['MODEL_DEFAULTS']["cache_size"])  # cache_size
+
+    print("Model options: ")
+    print(json.dumps(options))
+
+    return {"model": model,
             "encoder": encoder,
-            "options": mconfig.get("options", {}),
+            "options": options,
             "rweights": rweights,
             "cache": cache,
-            "hidden": None}
+            "rhyme_masks": rhyme_masks}
 
-        print("Model options: ")
-        print(json.dumps(models[modelname]['options']))
 
-    return models
+def load_models(config):
+    """
+    Registry of the models in MODEL_DIR. Only called at loading time, models
+    are loaded on first use (see `load_model`).
+    """
+    return ModelRegistry(
+        config['MODEL_DIR'], load=functools.partial(load_model, config))
 
 
 def process_seed(model, encoder, hidden, seed, seed_conds):
@@ -79,7 +109,9 @@ def process_seed(model, encoder, hidden, seed, seed_conds):
     (word, nwords), (char, nchars), conds = encoder.transform_batch([seed], [seed_conds])
 
     # TODO: add cache
-    _, hidden = model(word, nwords, char, nchars, conds, hidden)
+    # no autograd graph: the hidden state is kept in the session
+    with torch.no_grad():
+        _, hidden = model(word, nwords, char, nchars, conds, hidden)
 
     return hidden
 
@@ -108,7 +140,7 @@ def syllabify(syllabifier, words):
 
 def get_model_generation(mconfig, conds, tries, defaults,
                          # seed params
-                         seed=None, seed_conds=None):
+                         seed=None, seed_conds=None, hidden=None):
     """
     Run a model over a given seed to generate a continuation. This function
     shouldn't have any side-effects. Instead all updates are done by the
@@ -117,12 +149,13 @@ def get_model_generation(mconfig, conds, tries, defaults,
     Arguments:
     ----------
     - mconfig : dict, model-specific dictionary with keys:
-        "model", "encoder", "hidden", "cache", "options"
+        "model", "encoder", "cache", "options"
     - tries : int, number of candidates to sample from based on their probs
     - defaults : dict, app-level defaults for sampling options
     - conds : dict, dictionary of currently active conditions
     - seed : str, picked sentence to use as seed (already syllabified)
     - seed_conds : dict, dictionary of conditions used to generate previous sentence
+    - hidden : hidden state of the model after reading the previous seed
 
     Returns:
     --------
@@ -134,7 +167,7 @@ def get_model_generation(mconfig, conds, tries, defaults,
     model, encoder = mconfig["model"], mconfig['encoder']
 
     # update hidden with given seed
-    seed_hidden = mconfig["hidden"]
+    seed_hidden = hidden
     if seed is not None:
         seed_hidden = process_seed(model, encoder, seed_hidden, seed, seed_conds)
 
@@ -151,6 +184,26 @@ def get_model_generation(mconfig, conds, tries, defaults,
     # transform conditions to actual input
     conds = {c: vocab.w2i[conds[c]] for c, vocab in encoder.conds.items()}
 
+    # beam search: n-best in one pass, pick the best valid one
+    if mconfig["options"].get("beam"):
+        (hyps, _), scores, _ = model.beam_search(
+            encoder,
+            beam=mconfig["options"]["beam"],
+            conds=conds,
+            hidden=seed_hidden,
+            avoid_unk=defaults["avoid_unk"],
+            length_penalty=mconfig["options"].get("length_penalty", 1.0))
+
+        for hyp, score in zip(hyps, scores):
+            if utils.is_valid(hyp.split()) and \
+               (not seed or utils.is_valid_pair(hyp.split(), seed)):
+                return hyp, score, seed_hidden
+
+        return hyps[0], scores[0], seed_hidden
+
+    # the cache is updated in place, work on a copy to avoid side-effects
+    cache = mconfig["cache"].fork() if mconfig["cache"] is not None else None
+
     (hyps, _), scores, _, _ = model.sample(
         encoder,
         batch=tries,
@@ -158,7 +211,11 @@ def get_model_generation(mconfig, conds, tries, defaults,
         hidden=hidden,
         avoid_unk=defaults["avoid_unk"],
         tau=mconfig["options"].get("tau", defaults["tau"]),
-        cache=mconfig["cache"])
+        top_k=mconfig["options"].get("top_k", defaults.get("top_k", 0)),
+        top_p=mconfig["options"].get("top_p", defaults.get("top_p", 1.0)),
+        cache=cache,
+        rhyme_masks=mconfig.get("rhyme_masks"),
+        mask_syllables=mconfig["options"].get("mask_syllables", False))
 
     # sort by score to ensure best is last
     scores, hyps = zip(*sorted(list(zip(scores, hyps))))
@@ -189,15 +246,219 @@ def get_model_generation(mconfig, conds, tries, defaults,
     return hyp, score, seed_hidden
 
 
+class Speculator:
+    """
+    Bounded table of speculative generations of a session keyed by seed id.
+    Generations run in a background thread (possibly shared by all sessions)
+    and are only valid for the round in which they were submitted: `invalidate`
+    and `get` start a new round, dropping pending entries.
+    """
+    def __init__(self, maxsize, executor=None):
+        self.maxsize = maxsize
+        self.table = collections.OrderedDict()
+        self.round = 0
+        self.lock = threading.Lock()
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def invalidate(self):
+        with self.lock:
+            self.round += 1
+            for future in self.table.values():
+                future.cancel()
+            self.table.clear()
+
+    def submit(self, key, fn, *args):
+        def run(round):
+            if round != self.round:  # stale (don't waste time on it)
+                return
+            return fn(*args)
+
+        with self.lock:
+            self.table[key] = self.executor.submit(run, self.round)
+            # drop oldest entries
+            while len(self.table) > self.maxsize:
+                _, future = self.table.popitem(last=False)
+                future.cancel()
+
+    def get(self, key):
+        """
+        Result for `key` (waits if it is still running) or None if not available.
+        The other entries weren't picked and are dropped, and a generation that
+        hasn't started yet is cancelled (it would be queued behind the work of
+        other sessions, generating it directly is faster).
+        """
+        with self.lock:
+            future = self.table.pop(key, None)
+            self.round += 1
+            for other in self.table.values():
+                other.cancel()
+            self.table.clear()
+        if future is None or future.cancel():
+            return
+
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            return
+        except Exception as e:
+            print("Speculative generation failed: {}".format(e))
+            return
+
+
+class Session:
+    """
+    Generation state of a composition session
+
+    Attributes:
+    - counter : number of accepted candidates so far
+    - state : dictionary (see `Generator`)
+    - hidden : dictionary of modelname to the hidden state after reading the
+        last picked candidate
+    - speculator : Speculator or None
+    """
+    def __init__(self, counter=0, state=None, hidden=None):
+        self.counter = counter
+        self.state = state or {"hyps": {}, "conds": {}, "template": {}}
+        self.hidden = hidden or {}
+        self.speculator = None
+        self.lock = threading.RLock()
+        # modification time of the serialized session when it was last synced
+        self.stamp = None
+
+    # approximate memory of the rest of the state (conditions, hyps, ...)
+    OVERHEAD = 4096
+
+    def nbytes(self):
+        """
+        Approximate memory taken by the session
+        """
+        total = self.OVERHEAD
+        for hidden in self.hidden.values():
+            for h in hidden or []:
+                for t in (h if isinstance(h, tuple) else (h,)):
+                    total += t.numel() * t.element_size()
+        return total
+
+    def save(self, path):
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save({"counter": self.counter, "state": self.state, "hidden": self.hidden},
+                   tmppath)
+        os.replace(tmppath, path)
+        self.stamp = os.path.getmtime(path)
+
+    @classmethod
+    def load(cls, path):
+        inst = cls(**torch.load(path, map_location='cpu'))
+        inst.stamp = os.path.getmtime(path)
+        return inst
+
+
+class SessionStore:
+    """
+    LRU store of sessions within a memory budget in bytes (see `Session.nbytes`,
+    the most recently used session is always kept). If `spilldir` is given, sessions
+    are also written to it after every update, so that evicted sessions can be
+    restored and any worker process on the same machine can serve them (newer
+    serialized sessions take precedence over the ones in memory). Otherwise,
+    evicted sessions are written to a temporary directory and restored from it
+    on their next use.
+    """
+    def __init__(self, budget, spilldir=None, create=Session):
+        self.budget = budget
+        self.spilldir = spilldir
+        self.create = create
+        self.sessions = collections.OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        if spilldir is not None:
+            os.makedirs(spilldir, exist_ok=True)
+        # only without spilldir, created on first eviction
+        self.evictdir = None
+
+    def get_path(self, session_id, dirpath=None):
+        return os.path.join(dirpath or self.spilldir, '{}.session.pt'.format(session_id))
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None and self.evictdir is not None:
+                path = self.get_path(session_id, self.evictdir)
+                if os.path.isfile(path):
+                    try:
+                        session = Session.load(path)
+                    except Exception as e:
+                        print("Couldn't restore evicted session {}: {}".format(session_id, e))
+                    os.remove(path)
+            if self.spilldir is not None:
+                path = self.get_path(session_id)
+                if os.path.isfile(path) and (session is None or session.stamp is None or
+                                             os.path.getmtime(path) > session.stamp):
+                    try:
+                        session = Session.load(path)
+                    except Exception as e:
+                        print("Couldn't load session {}: {}".format(session_id, e))
+            if session is None:
+                session = self.create()
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            self.sizes[session_id] = session.nbytes()
+            self.evict()
+
+        return session
+
+    def put(self, session_id, session):
+        """
+        Register the updates of a session
+        """
+        if self.spilldir is not None:
+            try:
+                session.save(self.get_path(session_id))
+            except OSError as e:
+                print("Couldn't store session {}: {}".format(session_id, e))
+
+        with self.lock:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            self.sizes[session_id] = session.nbytes()
+            self.evict()
+
+    def evict(self):
+        """
+        Evict the least recently used sessions until the budget is met (the
+        caller holds the lock)
+        """
+        while sum(self.sizes.values()) > self.budget and len(self.sessions) > 1:
+            session_id, session = self.sessions.popitem(last=False)
+            self.sizes.pop(session_id, None)
+            if self.spilldir is not None:
+                continue  # already stored by `put`
+            if self.evictdir is None:
+                self.evictdir = tempfile.mkdtemp(prefix='sessions.')
+            try:
+                session.save(self.get_path(session_id, self.evictdir))
+            except OSError as e:
+                print("Couldn't store evicted session {}, it is lost: {}".format(
+                    session_id, e))
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.sizes.pop(session_id, None)
+            for dirpath in (self.spilldir, self.evictdir):
+                if dirpath is not None and os.path.isfile(self.get_path(session_id, dirpath)):
+                    os.remove(self.get_path(session_id, dirpath))
+
+
 class Generator:
     """
     Attributes:
     - config : AppConfig
-    - counter : number of accepted candidates so far
     - syllabifier : allennlp.services.Predictor
-    - tsampler : TemplateSampler or None
-    - models : dictionary
-    - state : dictionary,
+    - tsampler : TemplateStore, TemplateSampler or None
+    - models : ModelRegistry
+    - modelnames : names of the models used for generation
+    - sessions : SessionStore, with the `Session` of each composition session
+        (the `state` of each session is a dictionary:)
 
         { "conds": dict,
           "hyps": {
@@ -209,11 +470,11 @@ class Generator:
             }
           }
         }
+    - pool : executor running the models concurrently or None
+    - executor : executor of the speculative generations (see `Speculator`)
     """
     def __init__(self, config):
         self.config = config
-        # counter
-        self.counter = 0
         # load syllabifier
         if os.path.isfile(os.path.join(config['MODEL_DIR'], config['SYLLABIFIER'])):
             self.syllabifier = Predictor.from_path(
@@ -223,158 +484,246 @@ class Generator:
                 os.path.join(config['MODEL_DIR'], config['SYLLABIFIER'])))
         # load template sample if given
         self.tsampler = None
-        if os.path.isfile(config['SONG_PATH']) and os.path.isfile(config['PHON_DICT']):
+        if TemplateStore.exists(config['TEMPLATE_STORE']):
+            # precompiled templates (doesn't need the phonological dictionary)
+            self.tsampler = TemplateStore(config['TEMPLATE_STORE'])
+        elif os.path.isfile(config['SONG_PATH']) and os.path.isfile(config['PHON_DICT']):
             self.tsampler = TemplateSampler(config['SONG_PATH'], config['PHON_DICT'])
         else:
             print("Couldn't load TemplateSampler, files not found:\n\t{}\n\t{}".format(
                 config['SONG_PATH'], config['PHON_DICT']))
-        # load models
+        # load models (on first use), only the configured ones if MODELS is given
         self.models = load_models(config)
-        # reset state structures
-        self.state = {"hyps": {}, "conds": {}, "template": {}}
-        self.reset()
-
-    def get_conditions(self, encoder=None):
+        self.modelnames = [modelname for modelname in self.models
+                           if not config['MODELS'] or modelname in config['MODELS']]
+        # models generate concurrently in a pool of MODEL_WORKERS threads
+        self.pool = None
+        if config['MODEL_WORKERS'] > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config['MODEL_WORKERS'])
+        # split the (process-wide) torch threads among the concurrent generations:
+        # the model workers, which also run the speculative generations, or the
+        # request and the speculative thread
+        concurrent_generations = max(config['MODEL_WORKERS'], 1 + bool(config['SPECULATIVE']))
+        if concurrent_generations > 1:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // concurrent_generations))
+        # continuations of the offered candidates (computed in the background)
+        self.executor = None
+        if config['SPECULATIVE']:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # per-session state structures
+        self.sessions = SessionStore(
+            config['SESSION_MEMORY'], spilldir=config['SESSION_DIR'],
+            create=self.new_session)
+
+    def new_session(self):
+        session = Session()
+        self.reset_session(session)
+        return session
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if self.executor is not None and session.speculator is None:
+            session.speculator = Speculator(
+                self.config['SPECULATIVE_TABLE_SIZE'], executor=self.executor)
+        return session
+
+    def get_conditions(self, session):
         """
         Takes care of sampling conditions and planning the song over consecutive
         generations
         """
         encoder, maxconds = None, 0  # pick encoder with most conditions
-        for modelname, mconfig in self.models.items():
+        for modelname in self.modelnames:
+            mconfig = self.models[modelname]
             if len(mconfig['encoder'].conds) > maxconds:
                 encoder, maxconds = mconfig['encoder'], len(mconfig['encoder'].conds)
 
-        conds = self.state["conds"]
+        conds = session.state["conds"]
 
-        if self.state['template']:
-            template = self.state["template"]["data"]
+        if session.state['template']:
+            template = session.state["template"]["data"]
             # next step
-            conds = template[self.counter % len(template)]
+            conds = template[session.counter % len(template)]
 
         else:
-            if not conds or self.counter % 4 == 0:
+            if not conds or session.counter % 4 == 0:
                 # resample every 4
                 conds = sample_conditions(encoder)
 
         return conds
 
-    def resample(self):
+    def resample(self, session_id=DEFAULT_SESSION):
         """
         Recreate candidates for the current step without modifying any local state
         (hidden, cache, counter, conds).
         """
-        state = {**self.state, "hyps": {}}  # reset hyps
-        conds = state["conds"]
-        payload = []
-
-        for modelname, mconfig in self.models.items():
-            hyp, score, _ = get_model_generation(
-                mconfig, conds,
-                self.config['MODEL_TRIES'], self.config['MODEL_DEFAULTS'])
+        session = self.get_session(session_id)
+        with session.lock:
+            conds = session.state["conds"]
+            generations = self.generate(conds, session.hidden)
             # seed is the same as previous time around (no need to update hidden)
-            # update new hyps (always kept as they come from model.sample)
-            id = str(uuid.uuid1())[:8]
-            state["hyps"][modelname] = {id: {"hyp": hyp}}
+            hyps, payload = self.get_payload(generations, conds)
 
-            # payload
-            if isinstance(mconfig['model'], (RNNLanguageModel, HybridLanguageModel)):
-                hyp = utils.join_syllables(hyp.split())
-            hyp = utils.detokenize(hyp)
+            session.state = {**session.state, "hyps": hyps}
+            self.speculate(session)
+            self.sessions.put(session_id, session)
 
-            data = {
-                "id": "{}/{}".format(modelname, id),
-                "text": hyp,
-                "score": score,
-                "conds": conds}
+        return payload
 
-            payload.append(data)
+    def sample(self, seed_id=None, session_id=DEFAULT_SESSION):
+        """
+        Create new generations based on a picked seed. Update the session state
+        (hidden, cache, counter, conds) and the current hyps
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            generations = None
+            if seed_id is not None and session.speculator is not None:
+                generations = session.speculator.get(seed_id)
+
+            if generations is not None:
+                conds, generations = generations
+            else:
+                # prepare seed
+                seed = None
+                if seed_id is not None:
+                    seed = self.get_seed(seed_id, session.state["hyps"])
+                conds = self.get_conditions(session)
+                generations = self.generate(
+                    conds, session.hidden, seed=seed, seed_conds=session.state["conds"])
+
+            # reset hyps and conditions
+            hyps, payload = self.get_payload(generations, conds)
+            session.state = {**session.state, "conds": conds, "hyps": hyps}
 
-        self.state = state
+            # side-effects
+            # Warning! hidden is the state after reading the seed and NOT
+            # the state after generating the new candidates
+            session.hidden = {modelname: hidden
+                              for modelname, (_, _, hidden) in generations.items()}
+
+            # increment counter
+            session.counter += 1
+
+            self.speculate(session)
+            self.sessions.put(session_id, session)
 
         return payload
 
-    def sample(self, seed_id=None):
+    def get_seed(self, seed_id, hyps):
         """
-        Create new generations based on a picked seed. Update local state (hidden,
-        cache, counter, conds) and the current hyps
+        Retrieve the picked hyp as input for the models
         """
-        payload = []
+        if not hyps:
+            raise ValueError("Generator was passed seed {} but ")
 
-        # prepare seed
-        seed = None
-        if seed_id is not None:
-            if not self.state["hyps"]:
-                raise ValueError("Generator was passed seed {} but ")
+        modelname, id = seed_id.split('/')
+        try:
+            seed = hyps[modelname][id]["hyp"]
+        except KeyError:
+            raise ValueError("Couldn't find hyp {}".format(seed_id))
 
-            modelname, id = seed_id.split('/')
-            try:
-                seed = self.state["hyps"][modelname][id]["hyp"]
-            except KeyError:
-                raise ValueError("Couldn't find hyp {}".format(seed_id))
+        # list of words for CharLanguageModel, syllables for RNNLanguageModel
+        seed = seed.split()
+        if isinstance(self.models[modelname], CharLanguageModel):
+            # needs syllabification
+            seed = syllabify(self.syllabifier, seed)
 
-            # list of words for CharLanguageModel, syllables for RNNLanguageModel
-            seed = seed.split()
-            if isinstance(self.models[modelname], CharLanguageModel):
-                # needs syllabification
-                seed = syllabify(self.syllabifier, seed)
+        return seed
 
-        # reset hyps and conditions
-        conds = self.get_conditions()
-        state = {**self.state, "conds": conds, "hyps": {}}
+    def generate(self, conds, hidden, seed=None, seed_conds=None):
+        """
+        Run `get_model_generation` for all models (without side-effects) from
+        their hidden states in `hidden`, concurrently if a pool of model workers
+        is available (MODEL_WORKERS)
 
-        for modelname, mconfig in self.models.items():
-            # Warning! hidden is the state after reading the seed and NOT
-            # the state after generating the new candidates
-            hyp, score, hidden = get_model_generation(
-                mconfig, conds,
+        Returns: dict of modelname to (hyp, score, hidden)
+        """
+        def run(modelname):
+            return get_model_generation(
+                self.models[modelname], conds,
                 self.config['MODEL_TRIES'], self.config['MODEL_DEFAULTS'],
-                seed=seed, seed_conds=self.state["conds"])
+                seed=seed, seed_conds=seed_conds, hidden=hidden.get(modelname))
+
+        if self.pool is None:
+            return {modelname: run(modelname) for modelname in self.modelnames}
 
+        futures = {modelname: self.pool.submit(run, modelname) for modelname in self.modelnames}
+        return {modelname: future.result() for modelname, future in futures.items()}
+
+    def get_payload(self, generations, conds):
+        """
+        Create the new hyps and the payload of the candidates
+        """
+        hyps, payload = {}, []
+        for modelname, (hyp, score, _) in generations.items():
             # update new candidates (always kept as they come from model.sample)
             id = str(uuid.uuid1())[:8]
-            state["hyps"][modelname] = {id: {"hyp": hyp}}
+            hyps[modelname] = {id: {"hyp": hyp}}
 
             # payload
-            if isinstance(mconfig['model'], (RNNLanguageModel, HybridLanguageModel)):
+            if isinstance(self.models[modelname]['model'],
+                          (RNNLanguageModel, HybridLanguageModel)):
                 hyp = utils.join_syllables(hyp.split())
             hyp = utils.detokenize(hyp)
 
-            data = {
+            payload.append({
                 "id": "{}/{}".format(modelname, id),
                 "text": hyp,
                 "score": score,
-                "conds": conds}
+                "conds": conds})
 
-            payload.append(data)
+        return hyps, payload
 
-            # side-effects
-            self.models[modelname]["hidden"] = hidden
-            # self.models[modelname]["cache"] = cache
-
-        # reset state
-        self.state = state
-
-        # increment counter
-        self.counter += 1
-
-        return payload
+    def speculate(self, session):
+        """
+        Generate in the background the continuations of each offered candidate,
+        as `sample` would after it is picked (see `Speculator`)
+        """
+        if session.speculator is None:
+            return
+
+        session.speculator.invalidate()
+        hyps, seed_conds = session.state["hyps"], session.state["conds"]
+        # conditions of the next step don't depend on the picked seed
+        conds = self.get_conditions(session)
+        # hidden states aren't modified in place, the current ones can be shared
+        hidden = dict(session.hidden)
+
+        def continuation(seed_id):
+            seed = self.get_seed(seed_id, hyps)
+            return conds, self.generate(conds, hidden, seed=seed, seed_conds=seed_conds)
+
+        for modelname, ids in hyps.items():
+            for id in ids:
+                seed_id = "{}/{}".format(modelname, id)
+                session.speculator.submit(seed_id, continuation, seed_id)
+
+    def reset(self, session_id=DEFAULT_SESSION):
+        """
+        Start a new song in the session
+        """
+        session = self.sessions.get(session_id)
+        with session.lock:
+            self.reset_session(session)
+            self.sessions.put(session_id, session)
 
-    def reset(self):
-        self.counter = 0
+    def reset_session(self, session):
+        session.counter = 0
         # needs to stop any other model-related process first
-        for model, mconfig in self.models.items():
-            # reset hidden
-            mconfig["hidden"] = None
-            # reset cache if necessary
-            # if mconfig["cache"]:
-            #     mconfig["cache"] = mconfig["cache"].reset()
+        if session.speculator is not None:
+            session.speculator.invalidate()
+        session.hidden = {}
+        # reset cache if necessary
+        # for mconfig in self.models.loaded().values():
+        #     if mconfig["cache"]:
+        #         mconfig["cache"] = mconfig["cache"].reset()
 
-        self.state["conds"] = {}
-        self.state["hyps"] = {}
-        self.state["template"] = {}
+        session.state = {"hyps": {}, "conds": {}, "template": {}}
 
         if self.tsampler is not None and self.config['USE_TEMPLATE']:
             if random.random() <= self.config['TEMPLATE_RATIO']:
                 tdata, tmetadata = self.tsampler.sample(
                     nlines=self.config['TEMPLATE_MIN_LEN'])
-                self.state["template"] = {"data": tdata, "metadata": tmetadata}
+                session.state["template"] = {"data": tdata, "metadata": tmetadata}
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+from typing import Dict, Optional
+
+from celery import states
+
+
+class ResultListener:
+    """
+    Process-wide listener of the task results published by the redis result
+    backend (celery publishes every stored result on the channel of its key).
+    A single background thread holds one pubsub connection for all requests
+    waiting on a result, instead of each request querying the backend.
+
+    The thread starts with the first `wait` (and again after a fork, so that
+    pre-forking servers get one listener per worker process), which returns once
+    the subscription is active.
+    """
+    def __init__(self, backend, retry: float = 1.0):
+        self.backend = backend
+        self.retry = retry
+        self.lock = threading.Lock()
+        # task_id -> [event, meta, number of waiters]
+        self.pending = {}
+        self.thread = None
+        self.pid = None
+        # set while the pattern subscription is active
+        self.subscribed = threading.Event()
+
+    def start(self, timeout: float):
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.subscribed = threading.Event()
+                self.thread = threading.Thread(target=self.listen, daemon=True)
+                self.thread.start()
+        self.subscribed.wait(timeout)
+
+    def listen(self):
+        pattern = self.backend.get_key_for_task('*')
+        while True:
+            try:
+                pubsub = self.backend.client.pubsub()
+                pubsub.psubscribe(pattern)
+                for message in pubsub.listen():
+                    if message['type'] == 'psubscribe':
+                        self.subscribed.set()
+                    elif message['type'] == 'pmessage':
+                        self.notify(self.backend.decode_result(message['data']))
+            except Exception as e:
+                # waiters re-check the backend when they time out
+                self.subscribed.clear()
+                print('Result listener disconnected: {}'.format(e))
+                time.sleep(self.retry)
+
+    def notify(self, meta: Dict):
+        if meta.get('status') not in states.READY_STATES:
+            return
+        with self.lock:
+            waiter = self.pending.get(meta.get('task_id'))
+            if waiter is not None:
+                waiter[1] = meta
+                waiter[0].set()
+
+    def wait(self, task_id: str, timeout: float) -> Optional[Dict]:
+        """
+        Wait up to `timeout` seconds for the result of task `task_id`
+
+        Returns: the task meta (with 'status' and 'result') or None if the task
+            isn't ready yet
+        """
+        self.start(timeout)
+        with self.lock:
+            waiter = self.pending.setdefault(task_id, [threading.Event(), None, 0])
+            waiter[2] += 1
+        try:
+            # the result may have been stored before we started listening
+            meta = self.backend.get_task_meta(task_id)
+            if meta['status'] in states.READY_STATES:
+                return meta
+            if waiter[0].wait(timeout):
+                return waiter[1]
+            # in case the result was published while the listener wasn't subscribed
+            meta = self.backend.get_task_meta(task_id)
+            if meta['status'] in states.READY_STATES:
+                return meta
+        finally:
+            with self.lock:
+                waiter[2] -= 1
+                if waiter[2] == 0:
+                    del self.pending[task_id]
@@ -26,7 +26,7 @@ Vue.component('censored', {
 var app = new Vue({ 
   el: 'element',
   data: {
-    statusUrl: '/status/',
+    statusUrl: '/wait/',
     generateUrl: '/generate',
     submitUrl: '/upload',
     loading: false,
@@ -74,7 +74,7 @@ var app = new Vue({
               self.id = res.data.id
               self.log('received job id', {jobid: res.data.id})
               self.storeInBrowser()
-              setTimeout(self.polling, 1000)
+              self.polling()
             } else {
               self.loading = false
               self.log('error', 'did not receive job id, trying again in 1 sec')
@@ -96,8 +96,8 @@ var app = new Vue({
       let self = this
       axios.get(self.statusUrl + self.id).then(function(res) {
         if (!res.data.status || res.data.status === 'busy') {
-          // retry 
-          setTimeout(self.polling, 500)
+          // long poll timed out, wait again
+          self.polling()
         } else {
           self.loading = false
           if (res.data.status === 'fail') {
@@ -110,7 +110,7 @@ var app = new Vue({
           }
         }
       }).catch(function (err) {
-        self.log('error', 'http request failed /status/' + self.id)
+        self.log('error', 'http request failed ' + self.statusUrl + self.id)
         // console.warn('could not fetch status of id:' + self.id, err)
         // console.log('retry in 1 second')
         setTimeout(this.polling, 1000)
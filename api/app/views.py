@@ -17,6 +17,8 @@ from .models import Turn, Machine, Artist
 from .forms import LoginForm
 from .social import create_image_file
 from . import twitterconfig as tw
+from . import lyrics
+from .results import ResultListener
 
 
 @lm.user_loader
@@ -125,8 +127,10 @@ def generate() -> flask.Response:
     data = flask.request.json
     seed_id = (data or {}).get('seed_id', None)
     resample = (data or {}).get('resample', False)
-    job = generate_task.apply_async(
-        args=(seed_id, resample), queue=f'{flask_login.current_user.name}-queue')
+    # one composition session per machine
+    session_id = flask_login.current_user.name
+    queue = app.config['GENERATION_QUEUE'] or f'{session_id}-queue'
+    job = generate_task.apply_async(args=(seed_id, resample, session_id), queue=queue)
     return flask.jsonify({"id": job.id})
 
 
@@ -138,14 +142,32 @@ def get_status(id) -> flask.Response:
     return flask.jsonify(job.info)
 
 
+results = ResultListener(celery.backend)
+
+
+@app.route('/wait/<id>', methods=['GET'])
+def wait_status(id) -> flask.Response:
+    """
+    Long-polling version of `/status`: answers as soon as the job is done or
+    with "busy" after RESULT_TIMEOUT seconds
+    """
+    meta = results.wait(id, app.config['RESULT_TIMEOUT'])
+    if meta is None:
+        return flask.jsonify({"status": "busy"})
+    if meta['status'] != states.SUCCESS:
+        return flask.jsonify({'status': 'fail', 'message': str(meta['result']), 'code': 500})
+    return flask.jsonify(meta['result'])
+
+
 @celery.task
-def generate_task(seed_id, resample) -> Dict[str, str]:
+def generate_task(seed_id, resample, session_id=None) -> Dict[str, str]:
+    session_id = session_id or lyrics.DEFAULT_SESSION
     with app.app_context():
         try:
             if resample:
-                payload = app.Generator.resample()
+                payload = app.Generator.resample(session_id=session_id)
             else:
-                payload = app.Generator.sample(seed_id=seed_id)
+                payload = app.Generator.sample(seed_id=seed_id, session_id=session_id)
                 random.shuffle(payload)
             return {'status': 'OK', 'payload': payload}
         except Exception as e:
@@ -182,7 +204,8 @@ def save_session() -> flask.Response:
     data = flask.request.json
     with open(f'{app.config["LOG_DIR"]}/{uuid.uuid1()}.txt', 'w') as f:
         json.dump(data, f)
-    app.Generator.reset()
+    app.Generator.reset(
+        session_id=getattr(flask_login.current_user, 'name', lyrics.DEFAULT_SESSION))
     lines = [line['text'].strip() for line in data['lyric']]
     name = get_artist_name()
     if lines and random.random() <= 0.2:
@@ -7,21 +7,47 @@ class AppConfig:
     # GENERATION
     # - model configuration
     MODEL_TRIES = 1             # parallel tries per sentence
+    MODEL_WORKERS = 1           # models generating concurrently (torch threads are split)
     MODEL_DEFAULTS = {
         "tau": 0.8,
-        "avoid_unk": True
+        "avoid_unk": True,
+        "top_k": 0,       # truncated sampling (0 to disable)
+        "top_p": 1.0      # nucleus sampling (1.0 to disable)
     }
     MODEL_DIR = os.path.join(basedir, 'data/models/')
     MODELS = {
+        # # if given, only the listed models of MODEL_DIR are used
         # # add model-specific configuration in the following form
         # "path": "ModelName.pt",
         # "options": {
-        #    "tau": 0.95 }
+        #    "tau": 0.95,
+        #    "beam": 5,               # use beam search instead of sampling
+        #    "length_penalty": 1.0,
+        #    "quantize": True,        # int8 weights for rnns and projection (cpu)
+        #    "rhyme_mask": True,      # end lines only with words of the rhyme
+        #    "mask_syllables": True } # no broken syllable continuations
     }
+    # - speculative generation of the continuations of the offered candidates
+    SPECULATIVE = False
+    SPECULATIVE_TABLE_SIZE = 16  # max number of stored continuations
+    # - composition sessions: memory budget (bytes of hidden states) before the
+    #   least recently used sessions are evicted and directory where sessions are
+    #   stored after every update (None to store them only when evicted, in a
+    #   temporary directory). Storing them allows any worker on the machine to
+    #   serve any session.
+    SESSION_MEMORY = 256 * 2 ** 20
+    SESSION_DIR = None
+    # celery queue for generation tasks (None for a dedicated queue per machine)
+    GENERATION_QUEUE = None
+    # max seconds a /wait request is held open before answering "busy"
+    RESULT_TIMEOUT = 20
     # - syllabification
     SYLLABIFIER = "syllable-model.tar.gz"     # fpath of syllabifier in MODEL_DIR
     # - condition templates
     SONG_PATH = "data/ohhla-new.jsonl"        # file with songs in jsons format
+    # prefix of the precompiled templates (python -m generation.templates), used
+    # instead of SONG_PATH and PHON_DICT if present
+    TEMPLATE_STORE = "data/ohhla-new.templates"
     PHON_DICT = "data/ohhla.vocab.phon.json"  # file with phonological dictionary
     TEMPLATE_MIN_LEN = 3   # minimum #lines for a template
     # prop of songs created with template (only if template data is available)